@@ -1,6 +1,10 @@
 """
 Let's Encrypt ACME client for Lambda.
 Generates and renews TLS certificates using DNS-01 challenge via Route53.
+
+The same function serves GET /cert, so module-level imports are kept to what
+the API path needs. cryptography is only imported inside the renewal code
+(checked by ColdStartTest in tests/test_api.py).
 """
 
 import boto3
@@ -8,69 +12,465 @@ import json
 import os
 import time
 import hashlib
+import hmac
+import math
 import base64
-import urllib.request
-import urllib.error
+import collections
+import contextlib
+import concurrent.futures
+import gzip
+import random
+import re
+import socket
+import ssl
+import struct
+import threading
+import http.client
+import urllib.parse
 from datetime import datetime, timezone
-
-# Let's Encrypt production directory
-ACME_DIRECTORY = 'https://acme-v02.api.letsencrypt.org/directory'
+from email.utils import formatdate, parsedate_to_datetime
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# AWS clients, created on first use and reused across warm invocations
+CLIENT_CONFIG = Config(
+    connect_timeout=5,
+    read_timeout=15,
+    max_pool_connections=10,
+    retries={'max_attempts': 3, 'mode': 'standard'}
+)
+_clients = {}
+
+# Let's Encrypt production directory by default. ACME_DIRECTORY can point at
+# staging or a local test CA such as Pebble, with ACME_CA_BUNDLE to trust it.
+ACME_DIRECTORY = os.environ.get('ACME_DIRECTORY', 'https://acme-v02.api.letsencrypt.org/directory')
+ACME_CA_BUNDLE = os.environ.get('ACME_CA_BUNDLE')
+
+# Certificate key types: RSA key sizes, or names of cryptography EC curves
+CERT_KEY_TYPES = {
+    'rsa-2048': 2048,
+    'rsa-3072': 3072,
+    'rsa-4096': 4096,
+    'ec-p256': 'SECP256R1',
+    'ec-p384': 'SECP384R1',
+}
+
+# Nonces kept for reuse, and retry limits for failed ACME requests
+NONCE_POOL_SIZE = 5
+ACME_MAX_ATTEMPTS = 3
+ACME_MAX_RETRY_DELAY = 30
+
+# Idle keep-alive connections by host, reused across requests and warm invocations
+HTTP_TIMEOUT = 30
+_connections = {}
+
+# Parallel ACME requests for the names of an order (authorizations, challenges,
+# polls). Each run handles one order: a stack issues a single certificate.
+ACME_CONCURRENCY = 4
+
+# Let's Encrypt allows at most 100 names per certificate
+MAX_CERT_NAMES = 100
+
+# Route 53 allows at most 1000 records per ChangeBatch
+ROUTE53_MAX_BATCH_RECORDS = 1000
+
+# Hosted zone IDs by zone name, looked up once per container
+_hosted_zones = {}
+
+# Authoritative nameserver addresses by hosted zone ID
+DNS_PORT = int(os.environ.get('DNS_PORT', '53'))
+DNS_TIMEOUT = 2
+_nameservers = {}
+
+# Polling rounds in a row in which the nameservers can't be queried (while the
+# changes are INSYNC) before INSYNC alone is taken as enough
+UNREACHABLE_ROUNDS = 3
+
+# Polling limits (seconds) for DNS propagation and ACME status checks
+PROPAGATION_TIMEOUT = 120
+POLL_TIMEOUT = 90
+
+# CloudWatch namespace for issuance metrics (Embedded Metric Format log lines)
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'aws-easy/https-cert')
+
+# Seconds kept free at the end of an invocation to checkpoint and hand over
+RESUME_MARGIN = 30
+MAX_RESUMES = 5
+
+# SHA-256 digests of the accepted API tokens, parsed on the first API request.
+# CERT_TOKEN holds one or more comma-separated tokens (several while rotating),
+# each either plain or stored pre-hashed as sha256:<hex digest>.
+_token_digests = None
+
+# Failed logins per source IP: a bucket of AUTH_FAILURE_BURST attempts that
+# refills one per AUTH_FAILURE_REFILL seconds. An IP that empties its bucket
+# gets 429 for AUTH_BLOCK_SECONDS without its token being checked or logged.
+AUTH_FAILURE_BURST = 10
+AUTH_FAILURE_REFILL = 60
+AUTH_BLOCK_SECONDS = 60
+AUTH_TRACKED_IPS = 10000
+_auth_failures = {}
+
+# Fraction of routine API request log lines to keep (warnings and errors always logged)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+_request_id = None
+
+# Download formats for GET /cert, chosen with ?format= or the Accept header
+CERT_FORMATS = {
+    'json': 'application/json',
+    'pem': 'application/x-pem-file',        # full chain followed by the private key
+    'fullchain': 'application/x-pem-file',
+    'key': 'application/x-pem-file',
+    'der': 'application/pkix-cert',         # leaf certificate only
+    'p12': 'application/x-pkcs12',          # key, certificate and chain, no password
+    'meta': 'application/json',             # fingerprint, serial, expires and version only
+}
+ACCEPT_FORMATS = {
+    'application/json': 'json',
+    'application/x-pem-file': 'pem',
+    'application/pkix-cert': 'der',
+    'application/x-pkcs12': 'p12',
+}
+
+# Sanitised certificate payload served by the API, keyed by secret version.
+# bodies maps each format to its response body and whether it is base64;
+# gzipped holds compressed text bodies, filled on first request.
+_cert_cache = {
+    'bodies': None, 'gzipped': {}, 'version': None, 'expires': None, 'refresh_at': 0,
+    'etag': None, 'modified': 0, 'last_modified': None
+}
 
 
 def handler(event, context):
     """Handle EventBridge (renewal) or API Gateway (cert download) invocations."""
+    global _request_id
+    _request_id = getattr(context, 'aws_request_id', None)
 
     # API Gateway request - return certificate
     if 'requestContext' in event and 'http' in event.get('requestContext', {}):
-        return handle_api_request(event)
+        start = time.monotonic()
+        response = handle_api_request(event)
+        status = response['statusCode']
+        # Blocked clients were logged once when blocked; refuse them silently after that
+        if status != 429:
+            level = 'ERROR' if status >= 500 else 'WARNING' if status >= 400 else 'INFO'
+            log(level, 'API request', sampled=True, status=status,
+                ip=event['requestContext']['http'].get('sourceIp'),
+                latency_ms=round((time.monotonic() - start) * 1000, 1))
+        return response
 
     # EventBridge or Custom Resource - generate/renew certificate
     if event.get('RequestType'):
         # CloudFormation custom resource
         return handle_cfn_request(event, context)
 
-    # EventBridge scheduled event
-    return generate_certificate()
+    # EventBridge scheduled event, resumed issuance, or manual invoke with {"force": true}
+    return generate_certificate(force=event.get('force', False), context=context)
 
 
 def handle_api_request(event):
     """Handle GET /cert requests - return certificate from Secrets Manager."""
-    auth_header = event.get('headers', {}).get('authorization', '')
-    expected_token = os.environ.get('CERT_TOKEN', '')
+    source_ip = event['requestContext']['http'].get('sourceIp')
+    now = time.monotonic()
+    blocked_until = auth_blocked_until(source_ip, now)
+    if blocked_until:
+        return {
+            'statusCode': 429,
+            'headers': {'Retry-After': str(math.ceil(blocked_until - now))},
+            'body': json.dumps({'error': 'Too many failed attempts'})
+        }
 
-    if not auth_header.startswith('Bearer ') or auth_header[7:] != expected_token:
+    if not authorized(event.get('headers', {}).get('authorization', '')):
+        if record_auth_failure(source_ip, now):
+            log('WARNING', 'Blocking client after repeated authorization failures', ip=source_ip)
         return {
             'statusCode': 403,
             'body': json.dumps({'error': 'Invalid authorization'})
         }
 
-    # Retrieve certificate from Secrets Manager
-    try:
-        secrets = boto3.client('secretsmanager')
-        response = secrets.get_secret_value(SecretId=os.environ['CERT_SECRET_ARN'])
-        cert_data = json.loads(response['SecretString'])
+    request_headers = event.get('headers', {})
+    if event.get('rawPath', '').endswith('/meta'):
+        # GET /cert/meta: cheap polling to see whether a new certificate exists
+        cert_format = 'meta'
+    else:
+        cert_format = select_format(event.get('queryStringParameters') or {}, request_headers)
+    if cert_format is None:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': f"Unknown format, use one of: {', '.join(CERT_FORMATS)}"})
+        }
 
-        # Don't return the account key to clients
-        cert_data.pop('account_key', None)
+    # Retrieve certificate (cached in memory between requests)
+    try:
+        cert = get_cert_payload()
+        if cert_format not in cert['bodies']:
+            if len(cert['bodies']) > 1:
+                # Certificates stored before this format was added
+                error = 'This format is available after the next certificate renewal'
+            else:
+                error = 'Certificate not yet generated'
+            return {'statusCode': 404, 'body': json.dumps({'error': error})}
+
+        body, is_base64 = cert['bodies'][cert_format]
+        use_gzip = not is_base64 and 'gzip' in request_headers.get('accept-encoding', '')
+
+        headers = {
+            'Content-Type': CERT_FORMATS[cert_format],
+            'Cache-Control': f"private, max-age={os.environ.get('CERT_CACHE_TTL', '300')}",
+            'Last-Modified': cert['last_modified'],
+            'Vary': 'Accept, Accept-Encoding'
+        }
+        etag = None
+        if cert['etag']:
+            # Each format and encoding is a separate representation
+            suffix = ('' if cert_format == 'json' else f'-{cert_format}') + ('-gzip' if use_gzip else '')
+            etag = f'"{cert["etag"]}{suffix}"'
+            headers['ETag'] = etag
+
+        # Client already has this version
+        if not_modified(request_headers, etag, cert['modified']):
+            return {'statusCode': 304, 'headers': headers, 'body': ''}
+
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            body = gzipped_body(cert, cert_format)
+            is_base64 = True
 
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps(cert_data)
+            'headers': headers,
+            'body': body,
+            'isBase64Encoded': is_base64
         }
-    except secrets.exceptions.ResourceNotFoundException:
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            log('ERROR', 'Failed to retrieve certificate', error=str(e))
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'error': 'Failed to retrieve certificate'})
+            }
         return {
             'statusCode': 404,
             'body': json.dumps({'error': 'Certificate not yet generated'})
         }
     except Exception as e:
-        print(f"ERROR retrieving certificate: {e}")
+        log('ERROR', 'Failed to retrieve certificate', error=str(e))
         return {
             'statusCode': 500,
             'body': json.dumps({'error': 'Failed to retrieve certificate'})
         }
 
 
+def log(level, message, sampled=False, **fields):
+    """Print one JSON log line. Sampled INFO lines are kept at LOG_SAMPLE_RATE."""
+    if sampled and level == 'INFO' and random.random() >= LOG_SAMPLE_RATE:
+        return
+    print(json.dumps({'level': level, 'message': message, 'request_id': _request_id, **fields}, default=str))
+
+
+def load_token_digests(tokens):
+    """Return the SHA-256 digests of comma-separated plain or sha256:<hex> tokens.
+
+    A hashed entry that isn't 64 hex digits is logged and skipped, so a typo
+    can't stop the function from loading or silently never match.
+    """
+    digests = []
+    for token in filter(None, map(str.strip, tokens.split(','))):
+        if not token.startswith('sha256:'):
+            digests.append(hashlib.sha256(token.encode()).digest())
+        elif re.fullmatch('[0-9a-fA-F]{64}', token[7:]):
+            digests.append(bytes.fromhex(token[7:]))
+        else:
+            log('WARNING', 'Ignoring malformed sha256 token entry')
+    return digests
+
+
+def authorized(auth_header):
+    """Check a bearer token against every accepted token in constant time."""
+    global _token_digests
+    if _token_digests is None:
+        _token_digests = load_token_digests(os.environ.get('CERT_TOKEN', ''))
+    if not auth_header.startswith('Bearer '):
+        return False
+
+    # Comparing fixed-length digests hides the token length as well as its content
+    digest = hashlib.sha256(auth_header[7:].encode()).digest()
+    match = False
+    for token_digest in _token_digests:
+        match |= hmac.compare_digest(digest, token_digest)
+    return match
+
+
+def auth_blocked_until(source_ip, now):
+    """Return when a blocked client may try again, or None if it is not blocked."""
+    entry = _auth_failures.get(source_ip)
+    if entry and entry[2] > now:
+        return entry[2]
+    return None
+
+
+def record_auth_failure(source_ip, now):
+    """Take one attempt from the client's bucket. Returns True if it is now blocked."""
+    if len(_auth_failures) >= AUTH_TRACKED_IPS:
+        # Forget clients whose buckets have refilled completely
+        full = AUTH_FAILURE_BURST * AUTH_FAILURE_REFILL
+        for ip, (_, updated, blocked_until) in list(_auth_failures.items()):
+            if now - updated >= full and blocked_until <= now:
+                del _auth_failures[ip]
+        if len(_auth_failures) >= AUTH_TRACKED_IPS:
+            _auth_failures.clear()
+
+    tokens, updated, _ = _auth_failures.get(source_ip, (AUTH_FAILURE_BURST, now, 0))
+    tokens = min(AUTH_FAILURE_BURST, tokens + (now - updated) / AUTH_FAILURE_REFILL) - 1
+    blocked = tokens < 1
+    _auth_failures[source_ip] = (tokens, now, now + AUTH_BLOCK_SECONDS if blocked else 0)
+    return blocked
+
+
+def select_format(query, request_headers):
+    """Pick the download format from ?format= or the Accept header, or None if unknown."""
+    if 'format' in query:
+        return query['format'] if query['format'] in CERT_FORMATS else None
+
+    for media_type in request_headers.get('accept', '').split(','):
+        media_type = media_type.split(';')[0].strip().lower()
+        if media_type in ACCEPT_FORMATS:
+            return ACCEPT_FORMATS[media_type]
+    return 'json'
+
+
+def gzipped_body(cert, cert_format):
+    """Return the base64 gzip body for a text format, compressing it once per version."""
+    if cert_format not in cert['gzipped']:
+        body = cert['bodies'][cert_format][0]
+        cert['gzipped'][cert_format] = base64.b64encode(gzip.compress(body.encode(), mtime=0)).decode()
+    return cert['gzipped'][cert_format]
+
+
+def not_modified(request_headers, etag, modified):
+    """Check If-None-Match / If-Modified-Since against the current certificate."""
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match:
+        if not etag:
+            return False
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+
+    return False
+
+
+def pem_to_der(certificate_pem):
+    """Return the DER bytes of a single PEM certificate."""
+    lines = [line for line in certificate_pem.strip().splitlines() if not line.startswith('-----')]
+    return base64.b64decode(''.join(lines))
+
+
+def cert_fingerprint(certificate_pem):
+    """Return the hex SHA-256 fingerprint of a PEM certificate's DER bytes."""
+    return hashlib.sha256(pem_to_der(certificate_pem)).hexdigest()
+
+
+def get_cert_payload():
+    """Return the client-safe certificate entry, served from memory while fresh.
+
+    The secret is re-read after CERT_CACHE_TTL seconds or once the cached
+    certificate has expired. The bodies for every format, the ETag and
+    Last-Modified are only rebuilt when the secret version changes.
+    """
+    now = time.time()
+    if _cert_cache['bodies'] is not None and now < _cert_cache['refresh_at']:
+        return _cert_cache
+
+    secrets = get_client('secretsmanager')
+    response = secrets.get_secret_value(SecretId=os.environ['CERT_SECRET_ARN'])
+
+    if response['VersionId'] != _cert_cache['version']:
+        cert_data = json.loads(response['SecretString'])
+
+        # Certificates stored before the fingerprint was recorded
+        if cert_data.get('certificate') and not cert_data.get('fingerprint'):
+            cert_data['fingerprint'] = cert_fingerprint(cert_data['certificate'])
+
+        _cert_cache['bodies'] = cert_bodies(cert_data, response['VersionId'])
+        _cert_cache['gzipped'] = {}
+        _cert_cache['version'] = response['VersionId']
+        _cert_cache['expires'] = parse_expiry(cert_data.get('expires'))
+
+        # Strong validator: changes exactly when the certificate does
+        _cert_cache['etag'] = cert_data.get('fingerprint')
+
+        # HTTP dates have one-second resolution
+        _cert_cache['modified'] = int(response['CreatedDate'].timestamp())
+        _cert_cache['last_modified'] = formatdate(_cert_cache['modified'], usegmt=True)
+
+    ttl = int(os.environ.get('CERT_CACHE_TTL', '300'))
+    refresh_at = now + ttl
+    if _cert_cache['expires']:
+        refresh_at = min(refresh_at, _cert_cache['expires'])
+    _cert_cache['refresh_at'] = refresh_at
+
+    return _cert_cache
+
+
+def cert_bodies(cert_data, version):
+    """Render the stored certificate in every download format.
+
+    PKCS#12 needs cryptography, so it is built at issuance and stored
+    base64-encoded; the other formats are cut from the stored PEM.
+    """
+    pkcs12 = cert_data.pop('pkcs12', None)
+
+    # Certificates written before the account key moved to its own secret
+    cert_data.pop('account_key', None)
+
+    bodies = {'json': (json.dumps(cert_data, separators=(',', ':')), False)}
+    if not cert_data.get('certificate'):
+        return bodies
+
+    meta = {
+        'fingerprint': cert_data['fingerprint'],
+        'serial': cert_data.get('serial'),
+        'expires': cert_data.get('expires'),
+        'version': version
+    }
+
+    fullchain = cert_data['certificate'] + cert_data.get('chain', '')
+    bodies.update({
+        'meta': (json.dumps(meta, separators=(',', ':')), False),
+        'pem': (fullchain + cert_data['private_key'], False),
+        'fullchain': (fullchain, False),
+        'key': (cert_data['private_key'], False),
+        'der': (base64.b64encode(pem_to_der(cert_data['certificate'])).decode(), True),
+    })
+    if pkcs12:
+        bodies['p12'] = (pkcs12, True)
+    return bodies
+
+
+def parse_expiry(expires):
+    """Convert a stored ISO 8601 timestamp to a Unix timestamp, or None."""
+    try:
+        return datetime.fromisoformat(expires).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def get_client(service):
+    """Return a shared boto3 client for a service."""
+    client = _clients.get(service)
+    if client is None:
+        client = _clients[service] = boto3.client(service, config=CLIENT_CONFIG)
+    return client
+
+
 def handle_cfn_request(event, context):
     """Handle CloudFormation custom resource requests."""
     import urllib.request
@@ -81,14 +481,15 @@ def handle_cfn_request(event, context):
 
     try:
         if event['RequestType'] in ('Create', 'Update'):
-            result = generate_certificate()
-            if result.get('statusCode', 200) != 200:
+            result = generate_certificate(context=context)
+            # 202: issuance continues in a follow-up invocation
+            if result.get('statusCode', 200) not in (200, 202):
                 status = 'FAILED'
                 reason = result.get('body', 'Certificate generation failed')
     except Exception as e:
         status = 'FAILED'
         reason = str(e)
-        print(f"ERROR in CFN handler: {e}")
+        log('ERROR', 'CloudFormation request failed', error=str(e))
 
     # Send response to CloudFormation
     response_body = json.dumps({
@@ -112,250 +513,1004 @@ def handle_cfn_request(event, context):
     return {'statusCode': 200 if status == 'SUCCESS' else 500}
 
 
-def generate_certificate():
-    """Generate or renew a Let's Encrypt certificate."""
-    domain = os.environ['DOMAIN']
-    zone_id = os.environ['ZONE_ID']
+def get_domains():
+    """Return the certificate names: DOMAIN first, then any ADDITIONAL_NAMES."""
+    names = [os.environ['DOMAIN']]
+    names += os.environ.get('ADDITIONAL_NAMES', '').split(',')
+
+    domains = []
+    for name in names:
+        name = name.strip().rstrip('.').lower()
+        if name and name not in domains:
+            domains.append(name)
+
+    if len(domains) > MAX_CERT_NAMES:
+        raise Exception(
+            f"{len(domains)} names requested, but a certificate can have at most {MAX_CERT_NAMES}. "
+            "Use wildcard names or deploy another stack for the rest."
+        )
+    return domains
+
+
+def renewal_due(secret_data, domains, key_type):
+    """Check whether the stored certificate needs to be (re)issued.
+
+    A certificate is due when there is none, its names or key type differ
+    from the configured ones, or it expires within RENEW_BEFORE_DAYS.
+    """
+    expires = parse_expiry(secret_data.get('expires'))
+    if expires is None or 'certificate' not in secret_data:
+        return True
+    if secret_data.get('domains', [secret_data.get('domain')]) != domains:
+        return True
+    if secret_data.get('key_type', 'rsa-2048') != key_type:
+        return True
+
+    renew_before = int(os.environ.get('RENEW_BEFORE_DAYS', '30')) * 86400
+    return time.time() >= expires - renew_before
+
+
+def generate_certificate(force=False, context=None):
+    """Generate or renew a Let's Encrypt certificate.
+
+    Issuance progress is checkpointed, so a run that is about to time out
+    hands over to a fresh invocation which resumes where it stopped.
+    """
+    domains = get_domains()
+    key_type = get_key_type()
     secret_arn = os.environ['CERT_SECRET_ARN']
+    _metrics.reset()
+
+    secrets = get_client('secretsmanager')
+
+    # Load the stored certificate. Other read errors (throttling, access,
+    # timeouts) are raised rather than mistaken for a missing certificate,
+    # which would trigger an unnecessary renewal.
+    try:
+        response = secrets.get_secret_value(SecretId=secret_arn)
+        secret_data = json.loads(response['SecretString'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        secret_data = {}
+    except json.JSONDecodeError:
+        secret_data = {}
 
-    print(f"Generating certificate for {domain}")
+    # Resume an unfinished issuance for the same names
+    state = load_state()
+    if state and (state.get('domains'), state.get('key_type')) != (domains, key_type):
+        log('INFO', 'Discarding checkpoint for different names or key type')
+        state = None
+
+    # Nothing to do until the renewal window opens
+    if not state and not force and not renewal_due(secret_data, domains, key_type):
+        log('INFO', 'Certificate still valid, skipping renewal', expires=secret_data['expires'])
+        _metrics.emit(domains[0], 'skipped', detailed=False)
+        return {'statusCode': 200, 'body': json.dumps({
+            'message': 'Certificate still valid',
+            'expires': secret_data['expires']
+        })}
 
     try:
         # Import cryptography here to fail fast if unavailable
-        from cryptography.hazmat.primitives import serialization
-        from cryptography.hazmat.primitives.asymmetric import ec, rsa
+        from cryptography.hazmat.primitives.asymmetric import ec
         from cryptography.hazmat.backends import default_backend
-        from cryptography import x509
-        from cryptography.x509.oid import NameOID
-        from cryptography.hazmat.primitives import hashes
     except ImportError as e:
-        print(f"ERROR: cryptography library not available: {e}")
+        log('ERROR', 'cryptography library not available', error=str(e))
+        _metrics.emit(domains[0], 'failed')
         return {'statusCode': 500, 'body': 'cryptography library not available'}
 
-    secrets = boto3.client('secretsmanager')
-    route53 = boto3.client('route53')
+    try:
+        with _metrics.phase('account'):
+            # Get or create account key. A new key is saved straight away so a
+            # resumed issuance signs with the same account.
+            account_key = load_account_key(secret_data)
+            if account_key is None:
+                log('INFO', 'Creating new ACME account key')
+                account_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+                save_account_key(account_key)
+
+            # Get ACME directory
+            directory = json.loads(fetch_url(ACME_DIRECTORY))
+
+            # Nonces are fetched on demand and recovered from every response
+            nonces = NoncePool(directory['newNonce'])
+
+            # Create/retrieve account
+            signer = AcmeSigner(account_key)
+            account_url = acme_register(directory['newAccount'], signer, nonces)
+            log('INFO', 'ACME account', account_url=account_url)
+    except Exception:
+        # No order has been touched yet, so any checkpoint is kept for the next run
+        _metrics.emit(domains[0], 'failed')
+        raise
+
+    if state:
+        log('INFO', 'Resuming certificate issuance', step=state['step'])
+    else:
+        log('INFO', 'Generating certificate', domains=domains)
+        state = {'step': 'new', 'domains': domains, 'key_type': key_type, 'resumes': 0}
 
-    # Get or create account key
+    issuance = Issuance(state, directory, signer, nonces, secret_data, context)
     try:
-        response = secrets.get_secret_value(SecretId=secret_arn)
-        secret_data = json.loads(response['SecretString'])
-        if 'account_key' in secret_data:
-            account_key = serialization.load_pem_private_key(
-                secret_data['account_key'].encode(),
-                password=None,
-                backend=default_backend()
-            )
-        else:
-            account_key = None
-    except:
-        account_key = None
-        secret_data = {}
+        result = issuance.run()
+    except Exception:
+        _metrics.emit(domains[0], 'failed')
+        # Start from scratch next time rather than resume a failed order
+        clear_state()
+        raise
+
+    _metrics.emit(domains[0], 'issued' if result['statusCode'] == 200 else 'suspended')
+    return result
+
+
+class IssuanceMetrics:
+    """Per-run timings and counters, written as one CloudWatch EMF log line.
+
+    Phase durations, HTTP request and retry counts, and time spent sleeping
+    are collected during a run and emitted at the end, so dashboards and
+    alarms need no extra API calls.
+    """
+
+    PHASES = (
+        'account', 'order', 'keygen', 'csr', 'dns_publish', 'propagation',
+        'validation', 'finalize', 'download', 'store'
+    )
+    COUNTERS = ('HttpRequests', 'HttpRetries', 'AcmeRetries')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.sleep_time = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block of work as part of an issuance phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_sleep(self, seconds):
+        with self._lock:
+            self.sleep_time += seconds
+
+    def emit(self, domain, outcome, detailed=True):
+        """Print the run's metrics as an Embedded Metric Format JSON line.
+
+        With detailed=False (runs that did no issuance work) only TotalTime is
+        published, as each metric name is billed as a custom metric.
+        """
+        values = {'TotalTime': round((time.perf_counter() - self.started) * 1000)}
+        counters = {}
+        if detailed:
+            values.update({
+                f"{''.join(part.title() for part in name.split('_'))}Time": round(seconds * 1000)
+                for name, seconds in self.phases.items()
+            })
+            values['SleepTime'] = round(self.sleep_time * 1000)
+            counters = self.counters
+
+        metrics = [{'Name': name, 'Unit': 'Milliseconds'} for name in values]
+        metrics += [{'Name': name, 'Unit': 'Count'} for name in counters]
+        values.update(counters)
+
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Domain', 'Outcome']],
+                    'Metrics': metrics
+                }]
+            },
+            'Domain': domain,
+            'Outcome': outcome,
+            **values
+        }))
+
+
+_metrics = IssuanceMetrics()
+
 
-    if account_key is None:
-        print("Creating new ACME account key")
-        account_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+def sleep(seconds):
+    """Sleep during issuance, recording the time spent waiting."""
+    time.sleep(seconds)
+    _metrics.add_sleep(seconds)
 
-    # Get ACME directory
-    directory = json.loads(fetch_url(ACME_DIRECTORY))
 
-    # Get nonce
-    nonce = fetch_url(directory['newNonce'], method='HEAD', return_headers=True)['Replay-Nonce']
+def get_key_type():
+    """Return the configured certificate key type."""
+    key_type = os.environ.get('CERT_KEY_TYPE', 'rsa-2048').lower()
+    if key_type not in CERT_KEY_TYPES:
+        raise Exception(f"Unsupported CERT_KEY_TYPE: {key_type}")
+    return key_type
 
-    # Create/retrieve account
-    account_url, nonce = acme_register(directory['newAccount'], account_key, nonce)
-    print(f"ACME account: {account_url}")
 
-    # Generate certificate key
-    cert_key = rsa.generate_private_key(
+def generate_cert_key(key_type):
+    """Generate a certificate private key of the given type."""
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.hazmat.backends import default_backend
+
+    if key_type.startswith('ec-'):
+        curve = getattr(ec, CERT_KEY_TYPES[key_type])
+        return ec.generate_private_key(curve(), default_backend())
+
+    return rsa.generate_private_key(
         public_exponent=65537,
-        key_size=2048,
+        key_size=CERT_KEY_TYPES[key_type],
         backend=default_backend()
     )
 
-    # Create CSR
-    csr = x509.CertificateSigningRequestBuilder().subject_name(
-        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
-    ).add_extension(
-        x509.SubjectAlternativeName([x509.DNSName(domain)]),
-        critical=False
-    ).sign(cert_key, hashes.SHA256(), default_backend())
-
-    csr_der = csr.public_bytes(serialization.Encoding.DER)
-    csr_b64 = base64url_encode(csr_der)
-
-    # Create order
-    order_payload = {'identifiers': [{'type': 'dns', 'value': domain}]}
-    order_response, nonce = acme_request(
-        directory['newOrder'], account_key, account_url, nonce, order_payload
-    )
-    order = json.loads(order_response['body'])
-    order_url = order_response['headers'].get('Location')
-    print(f"Order created: {order_url}")
-
-    # Get authorization
-    auth_url = order['authorizations'][0]
-    auth_response, nonce = acme_request(auth_url, account_key, account_url, nonce, None)
-    auth = json.loads(auth_response['body'])
-
-    # Find DNS-01 challenge
-    challenge = None
-    for c in auth['challenges']:
-        if c['type'] == 'dns-01':
-            challenge = c
-            break
-
-    if not challenge:
-        raise Exception("No DNS-01 challenge found")
-
-    # Compute challenge response
-    thumbprint = jwk_thumbprint(account_key)
-    key_auth = f"{challenge['token']}.{thumbprint}"
-    dns_value = base64url_encode(hashlib.sha256(key_auth.encode()).digest())
-
-    # Create DNS TXT record
-    txt_name = f"_acme-challenge.{domain}"
-    print(f"Creating TXT record: {txt_name} = {dns_value}")
-
-    change_response = route53.change_resource_record_sets(
-        HostedZoneId=zone_id,
-        ChangeBatch={
-            'Changes': [{
-                'Action': 'UPSERT',
-                'ResourceRecordSet': {
-                    'Name': txt_name,
-                    'Type': 'TXT',
-                    'TTL': 60,
-                    'ResourceRecords': [{'Value': f'"{dns_value}"'}]
-                }
-            }]
-        }
-    )
-    change_id = change_response['ChangeInfo']['Id']
-
-    # Wait for DNS propagation
-    print("Waiting for DNS propagation...")
-    while True:
-        change_status = route53.get_change(Id=change_id)
-        if change_status['ChangeInfo']['Status'] == 'INSYNC':
-            break
-        time.sleep(5)
-
-    # Extra wait for DNS propagation
-    time.sleep(10)
-
-    # Notify ACME to verify challenge
-    print("Requesting challenge verification...")
-    _, nonce = acme_request(challenge['url'], account_key, account_url, nonce, {})
-
-    # Poll for authorization status
-    for _ in range(30):
-        auth_response, nonce = acme_request(auth_url, account_key, account_url, nonce, None)
-        auth = json.loads(auth_response['body'])
-
-        if auth['status'] == 'valid':
-            print("Challenge validated!")
-            break
-        elif auth['status'] == 'invalid':
-            raise Exception(f"Challenge failed: {auth}")
-
-        time.sleep(2)
-    else:
-        raise Exception("Challenge validation timeout")
 
-    # Finalize order
-    print("Finalizing order...")
-    _, nonce = acme_request(order['finalize'], account_key, account_url, nonce, {'csr': csr_b64})
+def reuse_cert_key(secret_data, key_type):
+    """Check whether the stored certificate key may be reused for this renewal.
+
+    Reuse is enabled by KEY_REUSE_RENEWALS (reuse for that many renewals)
+    and/or KEY_MAX_AGE_DAYS (reuse until the key is that old). When both are
+    set, both limits apply.
+    """
+    max_renewals = int(os.environ.get('KEY_REUSE_RENEWALS', '0'))
+    max_age_days = int(os.environ.get('KEY_MAX_AGE_DAYS', '0'))
+    if not max_renewals and not max_age_days:
+        return False
+
+    created = parse_expiry(secret_data.get('key_created'))
+    if not secret_data.get('private_key') or created is None:
+        return False
+    if secret_data.get('key_type', 'rsa-2048') != key_type:
+        return False
+
+    if max_renewals and secret_data.get('key_renewals', 0) >= max_renewals:
+        return False
+    if max_age_days and time.time() - created >= max_age_days * 86400:
+        return False
+    return True
+
+
+class Issuance:
+    """A certificate issuance driven as an explicit sequence of steps.
+
+    Each step moves state['step'] forward and the state is checkpointed after
+    every step. Steps that wait (DNS propagation, validation, finalization)
+    stop early when the invocation is running out of time; the run is then
+    suspended and continued by a new invocation.
+    """
+
+    STEPS = {
+        'new': 'create_order',
+        'ordered': 'publish_challenges',
+        'published': 'answer_challenges',
+        'answered': 'wait_for_validation',
+        'validated': 'finalize_order',
+        'finalized': 'wait_for_certificate',
+        'issued': 'store_certificate',
+    }
 
-    # Poll for certificate
-    for _ in range(30):
-        order_response, nonce = acme_request(order_url, account_key, account_url, nonce, None)
-        order = json.loads(order_response['body'])
+    def __init__(self, state, directory, signer, nonces, secret_data, context=None):
+        self.state = state
+        self.directory = directory
+        self.signer = signer
+        self.nonces = nonces
+        self.secret_data = secret_data
+        self.context = context
+        self.route53 = get_client('route53')
+
+    def remaining(self):
+        """Seconds left in this invocation."""
+        if self.context is None:
+            return float('inf')
+        return self.context.get_remaining_time_in_millis() / 1000
+
+    def budget(self, timeout):
+        """Time a wait may take in this invocation, leaving room to checkpoint."""
+        return max(min(timeout, self.remaining() - RESUME_MARGIN), 0)
+
+    def sleep(self, seconds):
+        """Sleep, but never into the time reserved for checkpointing."""
+        sleep(min(seconds, self.budget(seconds)))
+
+    def run(self):
+        while self.state['step'] != 'stored':
+            if self.remaining() < RESUME_MARGIN:
+                return self.suspend()
+
+            step = self.state['step']
+            getattr(self, self.STEPS[step])()
+            if self.state['step'] != step:
+                save_state(self.state)
+
+        clear_state()
+        expires = self.state['expires']
+        log('INFO', 'Certificate stored', expires=expires)
+        return {'statusCode': 200, 'body': json.dumps({'message': 'Certificate generated', 'expires': expires})}
+
+    def suspend(self):
+        """Checkpoint and continue issuance in a new invocation."""
+        self.state['resumes'] += 1
+        if self.state['resumes'] > MAX_RESUMES:
+            raise Exception(f"Issuance did not complete after {MAX_RESUMES} resumes")
+
+        save_state(self.state)
+        get_client('lambda').invoke(
+            FunctionName=self.context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'resume': True}).encode()
+        )
+        log('INFO', 'Suspended, resuming in a new invocation', step=self.state['step'])
+        return {'statusCode': 202, 'body': json.dumps({
+            'message': 'Certificate issuance in progress',
+            'step': self.state['step']
+        })}
+
+    def create_order(self):
+        """Generate the certificate key and CSR, create the order and collect challenges."""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.backends import default_backend
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes
 
-        if order['status'] == 'valid' and 'certificate' in order:
-            break
-        elif order['status'] == 'invalid':
-            raise Exception(f"Order failed: {order}")
+        domains = self.state['domains']
+
+        with _metrics.phase('keygen'):
+            # Reuse the previous certificate key if the policy allows, else generate one
+            if reuse_cert_key(self.secret_data, self.state['key_type']):
+                log('INFO', 'Reusing existing certificate key')
+                cert_key = serialization.load_pem_private_key(
+                    self.secret_data['private_key'].encode(),
+                    password=None,
+                    backend=default_backend()
+                )
+                key_created = self.secret_data['key_created']
+                key_renewals = self.secret_data.get('key_renewals', 0) + 1
+            else:
+                cert_key = generate_cert_key(self.state['key_type'])
+                key_created = datetime.now(timezone.utc).isoformat()
+                key_renewals = 0
+
+        with _metrics.phase('csr'):
+            # Create CSR covering every name
+            digest = hashes.SHA384() if self.state['key_type'] == 'ec-p384' else hashes.SHA256()
+            csr = x509.CertificateSigningRequestBuilder().subject_name(
+                x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domains[0])])
+            ).add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(name) for name in domains]),
+                critical=False
+            ).sign(cert_key, digest, default_backend())
+
+            csr_der = csr.public_bytes(serialization.Encoding.DER)
+
+        with _metrics.phase('order'):
+            # Create one order for all names
+            order_payload = {'identifiers': [{'type': 'dns', 'value': name} for name in domains]}
+            order_response = acme_request(
+                self.directory['newOrder'], self.signer, self.nonces, order_payload
+            )
+            order = json.loads(order_response['body'])
+            order_url = order_response['headers'].get('Location')
+            log('INFO', 'Order created', order_url=order_url)
+
+            # Collect a DNS-01 challenge for every authorization
+            auths = acme_map(self.fetch_authorization, order['authorizations'])
+            challenges = []
+            for auth_url, auth in zip(order['authorizations'], auths):
+                # Let's Encrypt reuses recent validations - nothing to prove
+                if auth['status'] == 'valid':
+                    log('INFO', 'Authorization already valid', name=auth['identifier']['value'])
+                    continue
+
+                challenge = None
+                for c in auth['challenges']:
+                    if c['type'] == 'dns-01':
+                        challenge = c
+                        break
+
+                if not challenge:
+                    raise Exception(f"No DNS-01 challenge found for {auth['identifier']['value']}")
+
+                # Compute challenge response
+                key_auth = f"{challenge['token']}.{self.signer.thumbprint}"
+                dns_value = base64url_encode(hashlib.sha256(key_auth.encode()).digest())
+                challenges.append({
+                    'auth_url': auth_url,
+                    'url': challenge['url'],
+                    # Wildcard names are validated on the base name
+                    'txt_name': f"_acme-challenge.{auth['identifier']['value']}",
+                    'value': dns_value
+                })
+
+        self.state.update({
+            # Skip DNS publishing and validation when every name is pre-authorized
+            'step': 'ordered' if challenges else 'validated',
+            'cert_key': cert_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ).decode(),
+            'key_created': key_created,
+            'key_renewals': key_renewals,
+            'csr': base64url_encode(csr_der),
+            'order_url': order_url,
+            'finalize': order['finalize'],
+            'challenges': challenges,
+            'txt_records': []
+        })
+
+    def fetch_authorization(self, auth_url):
+        """Return an authorization object."""
+        return json.loads(acme_request(auth_url, self.signer, self.nonces, None)['body'])
+
+    def txt_records(self):
+        """Published TXT values keyed by (zone_id, record_name)."""
+        return {(zone_id, name): values for zone_id, name, values in self.state['txt_records']}
+
+    def publish_challenges(self):
+        """Publish every TXT value in one ChangeBatch per hosted zone."""
+        with _metrics.phase('dns_publish'):
+            txt_records = {}
+            for c in self.state['challenges']:
+                log('INFO', 'Creating TXT record', name=c['txt_name'], value=c['value'])
+                zone_id = find_hosted_zone(self.route53, c['txt_name'])
+                txt_records.setdefault((zone_id, c['txt_name']), []).append(c['value'])
+
+            change_ids = change_txt_records(self.route53, txt_records, 'UPSERT')
+
+        self.state.update({
+            'step': 'published',
+            'txt_records': [[zone_id, name, values] for (zone_id, name), values in txt_records.items()],
+            'change_ids': change_ids
+        })
+
+    def answer_challenges(self):
+        """Wait until every value is in sync on Route 53 and served, then notify ACME."""
+        with _metrics.phase('propagation'):
+            log('INFO', 'Waiting for DNS propagation')
+            if not wait_for_propagation(self.route53, self.txt_records(), self.state['change_ids'],
+                                        timeout=self.budget(PROPAGATION_TIMEOUT)):
+                return
+
+        with _metrics.phase('validation'):
+            log('INFO', 'Requesting challenge verification')
+            acme_map(lambda c: acme_request(c['url'], self.signer, self.nonces, {}), self.state['challenges'])
+
+        self.state['step'] = 'answered'
+
+    def wait_for_validation(self):
+        """Poll every authorization until it is valid."""
+        with _metrics.phase('validation'):
+            budget = self.budget(POLL_TIMEOUT)
+            pending = [c['auth_url'] for c in self.state['challenges']]
+            for delay in backoff_delays(budget):
+                responses = acme_map(
+                    lambda auth_url: acme_request(auth_url, self.signer, self.nonces, None), pending
+                )
+                for auth_url, auth_response in zip(list(pending), responses):
+                    auth = json.loads(auth_response['body'])
+
+                    if auth['status'] == 'valid':
+                        log('INFO', 'Challenge validated', name=auth['identifier']['value'])
+                        pending.remove(auth_url)
+                    elif auth['status'] == 'invalid':
+                        raise Exception(f"Challenge failed: {auth}")
+
+                if not pending:
+                    self.state['step'] = 'validated'
+                    return
+
+                self.sleep(retry_after(auth_response['headers'], delay))
+
+            if budget >= POLL_TIMEOUT:
+                raise Exception("Challenge validation timeout")
+
+    def finalize_order(self):
+        """Submit the CSR, unless a previous invocation already did."""
+        with _metrics.phase('finalize'):
+            order_response = acme_request(self.state['order_url'], self.signer, self.nonces, None)
+            order = json.loads(order_response['body'])
+
+            if order['status'] == 'ready':
+                log('INFO', 'Finalizing order')
+                acme_request(self.state['finalize'], self.signer, self.nonces, {'csr': self.state['csr']})
+            elif order['status'] == 'invalid':
+                raise Exception(f"Order failed: {order}")
+
+        self.state['step'] = 'finalized'
+
+    def wait_for_certificate(self):
+        """Poll the order until the certificate is issued."""
+        with _metrics.phase('finalize'):
+            budget = self.budget(POLL_TIMEOUT)
+            for delay in backoff_delays(budget):
+                order_response = acme_request(self.state['order_url'], self.signer, self.nonces, None)
+                order = json.loads(order_response['body'])
+
+                if order['status'] == 'valid' and 'certificate' in order:
+                    self.state.update({'step': 'issued', 'certificate_url': order['certificate']})
+                    return
+                elif order['status'] == 'invalid':
+                    raise Exception(f"Order failed: {order}")
+
+                self.sleep(retry_after(order_response['headers'], delay))
+
+            if budget >= POLL_TIMEOUT:
+                raise Exception("Order finalization timeout")
+
+    def store_certificate(self):
+        """Download the certificate, clean up DNS and store it in Secrets Manager."""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        from cryptography.hazmat.backends import default_backend
+        from cryptography import x509
 
-        time.sleep(2)
-    else:
-        raise Exception("Order finalization timeout")
-
-    # Download certificate
-    print("Downloading certificate...")
-    cert_response, _ = acme_request(order['certificate'], account_key, account_url, nonce, None)
-    cert_pem = cert_response['body']
-
-    # Parse certificate chain
-    certs = cert_pem.split('-----END CERTIFICATE-----')
-    certificate = certs[0] + '-----END CERTIFICATE-----\n'
-    chain = '-----END CERTIFICATE-----'.join(certs[1:]).strip()
-    if chain:
-        chain = chain + '\n'
-
-    # Parse expiry
-    cert_obj = x509.load_pem_x509_certificate(certificate.encode(), default_backend())
-    expires = cert_obj.not_valid_after_utc.isoformat()
-
-    # Cleanup DNS record
-    print("Cleaning up TXT record...")
-    try:
-        route53.change_resource_record_sets(
-            HostedZoneId=zone_id,
-            ChangeBatch={
-                'Changes': [{
-                    'Action': 'DELETE',
-                    'ResourceRecordSet': {
-                        'Name': txt_name,
-                        'Type': 'TXT',
-                        'TTL': 60,
-                        'ResourceRecords': [{'Value': f'"{dns_value}"'}]
-                    }
-                }]
+        with _metrics.phase('download'):
+            # Download certificate
+            log('INFO', 'Downloading certificate')
+            cert_response = acme_request(self.state['certificate_url'], self.signer, self.nonces, None)
+            cert_pem = cert_response['body']
+
+            # Parse certificate chain
+            certs = cert_pem.split('-----END CERTIFICATE-----')
+            certificate = certs[0] + '-----END CERTIFICATE-----\n'
+            chain = '-----END CERTIFICATE-----'.join(certs[1:]).strip()
+            if chain:
+                chain = chain + '\n'
+
+            # Parse expiry
+            cert_obj = x509.load_pem_x509_certificate(certificate.encode(), default_backend())
+            expires = cert_obj.not_valid_after_utc.isoformat()
+
+            # Build the PKCS#12 download once here, so the API needs no cryptography
+            chain_objs = [
+                x509.load_pem_x509_certificate(c.encode() + b'-----END CERTIFICATE-----\n', default_backend())
+                for c in certs[1:] if c.strip()
+            ]
+            cert_key = serialization.load_pem_private_key(
+                self.state['cert_key'].encode(), password=None, backend=default_backend()
+            )
+            p12 = pkcs12.serialize_key_and_certificates(
+                self.state['domains'][0].encode(), cert_key, cert_obj, chain_objs or None,
+                serialization.NoEncryption()
+            )
+
+        with _metrics.phase('store'):
+            # Cleanup DNS records
+            if self.state['txt_records']:
+                log('INFO', 'Cleaning up TXT records')
+                try:
+                    change_txt_records(self.route53, self.txt_records(), 'DELETE')
+                except Exception as e:
+                    log('WARNING', 'Failed to delete TXT records', error=str(e))
+
+            # Store the certificate with everything GET /cert serves
+            domains = self.state['domains']
+            fingerprint = cert_fingerprint(certificate)
+            cert_data = {
+                'certificate': certificate,
+                'chain': chain,
+                'private_key': self.state['cert_key'],
+                'domain': domains[0],
+                'domains': domains,
+                'key_type': self.state['key_type'],
+                'key_created': self.state['key_created'],
+                'key_renewals': self.state['key_renewals'],
+                'expires': expires,
+                'fingerprint': fingerprint,
+                'serial': format(cert_obj.serial_number, 'x'),
+                'pkcs12': base64.b64encode(p12).decode()
             }
+
+            # Without an account secret the key has to travel with the certificate
+            if not os.environ.get('ACCOUNT_SECRET_ARN'):
+                cert_data['account_key'] = private_key_pem(self.signer.key)
+
+            # One write: the new version becomes AWSCURRENT and the old one
+            # AWSPREVIOUS. The fingerprint as request token means a retried
+            # store never adds a second version for the same certificate.
+            try:
+                version = get_client('secretsmanager').put_secret_value(
+                    SecretId=os.environ['CERT_SECRET_ARN'],
+                    ClientRequestToken=fingerprint,
+                    SecretString=json.dumps(cert_data, separators=(',', ':')),
+                    VersionStages=['AWSCURRENT']
+                )['VersionId']
+            except ClientError as e:
+                # A retried store rebuilds the PKCS#12 file, whose random MAC salt
+                # makes the content differ. Secrets Manager then rejects the reused
+                # token, but this certificate is already stored under it.
+                if e.response['Error']['Code'] != 'ResourceExistsException':
+                    raise
+                log('INFO', 'Certificate already stored', fingerprint=fingerprint)
+                version = fingerprint
+
+            # Make API requests in this container pick up the new version
+            _cert_cache['refresh_at'] = 0
+
+        notify_rotation(cert_data, version)
+        self.state.update({'step': 'stored', 'expires': expires})
+
+
+def notify_rotation(cert_data, version):
+    """Tell subscribers that a new certificate is available.
+
+    Published to the SNS topic in ROTATION_TOPIC_ARN, which can fan out to
+    email, HTTPS webhooks, SQS queues or other functions. The message never
+    contains key material. The certificate is already stored at this point,
+    so a failed publish is logged rather than raised.
+    """
+    topic_arn = os.environ.get('ROTATION_TOPIC_ARN')
+    if not topic_arn:
+        return
+
+    message = {key: cert_data.get(key) for key in ('domain', 'domains', 'fingerprint', 'serial', 'expires')}
+    message['version'] = version
+    try:
+        get_client('sns').publish(
+            TopicArn=topic_arn,
+            Subject=f"New certificate for {cert_data['domain']}"[:100],
+            Message=json.dumps(message),
+            MessageAttributes={'domain': {'DataType': 'String', 'StringValue': cert_data['domain']}}
         )
+        log('INFO', 'Rotation notification published', fingerprint=cert_data['fingerprint'])
     except Exception as e:
-        print(f"Warning: failed to delete TXT record: {e}")
+        log('WARNING', 'Failed to publish rotation notification', error=str(e))
 
-    # Store certificate in Secrets Manager
-    private_key_pem = cert_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()
-    ).decode()
 
-    account_key_pem = account_key.private_bytes(
+def private_key_pem(key):
+    """Serialize a private key as unencrypted PKCS#8 PEM."""
+    from cryptography.hazmat.primitives import serialization
+
+    return key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     ).decode()
 
-    cert_data = {
-        'certificate': certificate,
-        'chain': chain,
-        'private_key': private_key_pem,
-        'domain': domain,
-        'expires': expires,
-        'account_key': account_key_pem
-    }
 
-    secrets.put_secret_value(SecretId=secret_arn, SecretString=json.dumps(cert_data))
+def load_account_key(secret_data):
+    """Return the ACME account key, or None if no account exists yet.
+
+    Certificates stored by older versions carry the account key in the
+    certificate secret; it is moved to the account secret on first use.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.backends import default_backend
+
+    account_arn = os.environ.get('ACCOUNT_SECRET_ARN')
+    account_pem = None
+    if account_arn:
+        response = get_client('secretsmanager').get_secret_value(SecretId=account_arn)
+        account_pem = json.loads(response['SecretString']).get('account_key')
+
+    legacy_pem = secret_data.get('account_key')
+    if not (account_pem or legacy_pem):
+        return None
+
+    key = serialization.load_pem_private_key(
+        (account_pem or legacy_pem).encode(),
+        password=None,
+        backend=default_backend()
+    )
+    if not account_pem:
+        save_account_key(key)
+    return key
+
+
+def save_account_key(key):
+    """Store the ACME account key in its own secret."""
+    account_arn = os.environ.get('ACCOUNT_SECRET_ARN')
+    if account_arn:
+        get_client('secretsmanager').put_secret_value(
+            SecretId=account_arn,
+            SecretString=json.dumps({'account_key': private_key_pem(key)})
+        )
+
+
+def load_state():
+    """Return the checkpoint of an unfinished issuance, or None."""
+    state_arn = os.environ.get('STATE_SECRET_ARN')
+    if not state_arn:
+        return None
+    try:
+        response = get_client('secretsmanager').get_secret_value(SecretId=state_arn)
+        return json.loads(response['SecretString']) or None
+    except Exception as e:
+        log('WARNING', 'Failed to load issuance checkpoint', error=str(e))
+        return None
+
+
+def save_state(state):
+    """Checkpoint issuance progress."""
+    state_arn = os.environ.get('STATE_SECRET_ARN')
+    if state_arn:
+        get_client('secretsmanager').put_secret_value(SecretId=state_arn, SecretString=json.dumps(state))
+
+
+def clear_state():
+    """Remove the checkpoint once issuance has finished or failed."""
+    state_arn = os.environ.get('STATE_SECRET_ARN')
+    if state_arn:
+        try:
+            get_client('secretsmanager').put_secret_value(SecretId=state_arn, SecretString='{}')
+        except Exception as e:
+            log('WARNING', 'Failed to clear issuance checkpoint', error=str(e))
+
+
+def get_connection(scheme, host):
+    """Take an idle keep-alive connection for a host from the pool, or open one."""
+    try:
+        return _connections.setdefault((scheme, host), []).pop()
+    except IndexError:
+        if scheme == 'https':
+            context = ssl.create_default_context(cafile=ACME_CA_BUNDLE) if ACME_CA_BUNDLE else None
+            return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT, context=context)
+        return http.client.HTTPConnection(host, timeout=HTTP_TIMEOUT)
+
+
+def http_request(url, method='GET', data=None, headers=None):
+    """Send a request over a pooled connection. Returns (status, headers, body).
+
+    Each connection is used by one request at a time, so this is safe to call
+    from several threads.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = f"{path}?{parts.query}"
+
+    for attempt in range(2):
+        conn = get_connection(parts.scheme, parts.netloc)
+        reused = conn.sock is not None
+        _metrics.count('HttpRequests')
+        try:
+            conn.request(method, path, body=data, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read().decode()
+        except (http.client.HTTPException, OSError) as e:
+            # A pooled keep-alive connection may have been closed or gone stale
+            # since its last use (reset, TLS EOF, timeout) - reconnect once
+            conn.close()
+            if attempt or not (reused or isinstance(e, (http.client.HTTPException, ConnectionError))):
+                raise
+            _metrics.count('HttpRetries')
+            continue
+
+        if response.will_close:
+            conn.close()
+        else:
+            _connections[(parts.scheme, parts.netloc)].append(conn)
+        return response.status, response.msg, body
+
+
+def acme_map(func, items):
+    """Run func over items on a small thread pool, returning results in order.
+
+    The pool size is kept low to stay well within Let's Encrypt rate limits.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ACME_CONCURRENCY) as executor:
+        return list(executor.map(func, items))
+
+
+def find_hosted_zone(route53, name):
+    """Find the ID of the most specific hosted zone containing a record name."""
+    parts = name.rstrip('.').split('.')
+    for i in range(len(parts) - 1):
+        zone_name = '.'.join(parts[i:]) + '.'
+        if zone_name not in _hosted_zones:
+            _hosted_zones[zone_name] = None
+            zones = route53.list_hosted_zones_by_name(DNSName=zone_name)
+            for zone in zones.get('HostedZones', []):
+                if zone['Name'] == zone_name and not zone.get('Config', {}).get('PrivateZone'):
+                    _hosted_zones[zone_name] = zone['Id'].replace('/hostedzone/', '')
+                    break
+        if _hosted_zones[zone_name]:
+            return _hosted_zones[zone_name]
+
+    raise Exception(f"No hosted zone found for {name}")
+
+
+def change_txt_records(route53, txt_records, action):
+    """Apply TXT record changes with one ChangeBatch per hosted zone.
+
+    txt_records maps (zone_id, record_name) to a list of TXT values. Batches
+    are split to stay within Route 53's per-request record limit.
+    Returns the change IDs to wait on.
+    """
+    # UPSERT counts twice towards the limit
+    weight = 2 if action == 'UPSERT' else 1
+
+    batches = {}
+    sizes = {}
+    for (zone_id, txt_name), values in txt_records.items():
+        zone_batches = batches.setdefault(zone_id, [[]])
+        size = len(values) * weight
+        if zone_batches[-1] and sizes[zone_id] + size > ROUTE53_MAX_BATCH_RECORDS:
+            zone_batches.append([])
+            sizes[zone_id] = 0
+        sizes[zone_id] = sizes.get(zone_id, 0) + size
+        zone_batches[-1].append({
+            'Action': action,
+            'ResourceRecordSet': {
+                'Name': txt_name,
+                'Type': 'TXT',
+                'TTL': 60,
+                'ResourceRecords': [{'Value': f'"{value}"'} for value in values]
+            }
+        })
+
+    change_ids = []
+    for zone_id, zone_batches in batches.items():
+        for changes in zone_batches:
+            response = route53.change_resource_record_sets(
+                HostedZoneId=zone_id,
+                ChangeBatch={'Changes': changes}
+            )
+            change_ids.append(response['ChangeInfo']['Id'])
+    return change_ids
+
+
+def backoff_delays(timeout, initial=1, maximum=10):
+    """Yield exponentially growing, jittered delays until timeout seconds pass."""
+    deadline = time.monotonic() + timeout
+    delay = initial
+    while time.monotonic() < deadline:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, maximum)
 
-    print(f"Certificate stored successfully! Expires: {expires}")
-    return {'statusCode': 200, 'body': json.dumps({'message': 'Certificate generated', 'expires': expires})}
+
+def retry_after(headers, default):
+    """Return the Retry-After delay in seconds, or default if absent."""
+    value = headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(seconds, 0), POLL_TIMEOUT)
+
+
+def get_nameservers(route53, zone_id):
+    """Return the IP addresses of a hosted zone's authoritative nameservers."""
+    if zone_id not in _nameservers:
+        zone = route53.get_hosted_zone(Id=zone_id)
+        addresses = []
+        for host in zone['DelegationSet']['NameServers']:
+            try:
+                addresses.append(socket.gethostbyname(host))
+            except OSError as e:
+                log('WARNING', 'Failed to resolve nameserver', host=host, error=str(e))
+        _nameservers[zone_id] = addresses
+    return _nameservers[zone_id]
+
+
+def query_txt(server, name, port=None):
+    """Query a nameserver directly for TXT records. Returns a set of values."""
+    query_id = random.getrandbits(16)
+    question = b''.join(
+        bytes([len(label)]) + label.encode() for label in name.rstrip('.').split('.')
+    ) + b'\0' + struct.pack('>HH', 16, 1)
+    packet = struct.pack('>HHHHHH', query_id, 0, 1, 0, 0, 0) + question
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(DNS_TIMEOUT)
+        sock.sendto(packet, (server, port or DNS_PORT))
+        response, _ = sock.recvfrom(4096)
+
+    response_id, _, _, answer_count, _, _ = struct.unpack('>HHHHHH', response[:12])
+    if response_id != query_id:
+        raise Exception("DNS response ID mismatch")
+
+    # Skip the echoed question
+    offset = 12 + len(question)
+    values = set()
+    for _ in range(answer_count):
+        # Skip the owner name (label sequence or compression pointer)
+        while response[offset]:
+            if response[offset] >= 0xC0:
+                offset += 1
+                break
+            offset += response[offset] + 1
+        offset += 1
+
+        record_type, _, _, length = struct.unpack('>HHIH', response[offset:offset + 10])
+        offset += 10
+        if record_type == 16:
+            # TXT data is one or more length-prefixed strings
+            data = response[offset:offset + length]
+            parts = []
+            i = 0
+            while i < len(data):
+                parts.append(data[i + 1:i + 1 + data[i]].decode())
+                i += data[i] + 1
+            values.add(''.join(parts))
+        offset += length
+
+    return values
+
+
+def txt_visible(route53, txt_records):
+    """Check whether every authoritative nameserver serves all TXT values.
+
+    Returns None instead of False when a nameserver can't be queried (or a
+    zone's nameservers couldn't be resolved), as that says nothing about the
+    records.
+    """
+    for (zone_id, txt_name), values in txt_records.items():
+        nameservers = get_nameservers(route53, zone_id)
+        if not nameservers:
+            return None
+        for server in nameservers:
+            try:
+                if not set(values) <= query_txt(server, txt_name):
+                    return False
+            except Exception:
+                return None
+    return True
+
+
+def wait_for_propagation(route53, txt_records, change_ids, timeout=PROPAGATION_TIMEOUT):
+    """Wait until published TXT records are live on every Route 53 nameserver.
+
+    Route 53 nameserver addresses are anycast, so a direct query only shows
+    that the nearest edge has the records. The changes must also be INSYNC
+    (applied on all Route 53 servers), because Let's Encrypt validates from
+    several network locations. Both are polled with exponential backoff and
+    jitter. If the nameservers can't be queried for UNREACHABLE_ROUNDS rounds
+    in a row, INSYNC alone is enough; if they answer without the values, it is
+    only enough once the timeout runs out. Returns False if the changes are
+    not INSYNC in time.
+    """
+    pending = list(change_ids)
+    unreachable = 0
+    for delay in backoff_delays(timeout):
+        pending = [
+            change_id for change_id in pending
+            if route53.get_change(Id=change_id)['ChangeInfo']['Status'] != 'INSYNC'
+        ]
+        if not pending:
+            visible = txt_visible(route53, txt_records)
+            if visible:
+                return True
+            unreachable = unreachable + 1 if visible is None else 0
+            if unreachable >= UNREACHABLE_ROUNDS:
+                log('WARNING', 'Nameservers could not be queried, continuing as Route 53 reports the records in sync')
+                return True
+        sleep(delay)
+
+    if pending:
+        # Out of time in this invocation - check again when resumed
+        return False
+
+    log('WARNING', 'TXT records not visible on nameservers, continuing as Route 53 reports them in sync')
+    return True
 
 
 def fetch_url(url, method='GET', data=None, headers=None, return_headers=False):
     """Fetch a URL and return the response."""
-    req = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+    status, response_headers, body = http_request(url, method, data, headers)
 
-    try:
-        with urllib.request.urlopen(req) as response:
-            if return_headers:
-                return dict(response.headers)
-            return response.read().decode()
-    except urllib.error.HTTPError as e:
-        body = e.read().decode()
-        raise Exception(f"HTTP {e.code}: {body}")
+    if status >= 400:
+        raise Exception(f"HTTP {status}: {body}")
+    if return_headers:
+        return response_headers
+    return body
 
 
 def base64url_encode(data):
@@ -365,105 +1520,134 @@ def base64url_encode(data):
     return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
 
 
-def jwk_thumbprint(key):
-    """Compute JWK thumbprint for an EC key."""
-    from cryptography.hazmat.primitives.asymmetric import ec
+class AcmeSigner:
+    """Signs ACME requests with an EC P-256 account key.
 
-    public_key = key.public_key()
-    numbers = public_key.public_numbers()
+    The JWK, its thumbprint and the signing primitives are computed once per
+    account key and reused for every request in a run. Once the account is
+    registered, kid replaces the JWK in the protected header.
+    """
+
+    def __init__(self, key):
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+        from cryptography.hazmat.primitives import hashes
 
-    if isinstance(key, ec.EllipticCurvePrivateKey):
-        # EC key
-        x = numbers.x.to_bytes(32, 'big')
-        y = numbers.y.to_bytes(32, 'big')
+        if not isinstance(key, ec.EllipticCurvePrivateKey):
+            raise Exception("Unsupported key type")
+
+        numbers = key.public_key().public_numbers()
         jwk = {
             'crv': 'P-256',
             'kty': 'EC',
-            'x': base64url_encode(x),
-            'y': base64url_encode(y)
+            'x': base64url_encode(numbers.x.to_bytes(32, 'big')),
+            'y': base64url_encode(numbers.y.to_bytes(32, 'big'))
         }
-    else:
-        raise Exception("Unsupported key type")
+        jwk_json = json.dumps(jwk, sort_keys=True, separators=(',', ':'))
+
+        self.key = key
+        self.thumbprint = base64url_encode(hashlib.sha256(jwk_json.encode()).digest())
+        self.kid = None
+        self._key_header = f'"jwk":{jwk_json}'
+        self._algorithm = ec.ECDSA(hashes.SHA256())
+        self._decode_signature = decode_dss_signature
+
+    def set_kid(self, account_url):
+        """Identify by account URL instead of JWK in later requests."""
+        self.kid = account_url
+        self._key_header = f'"kid":{json.dumps(account_url)}'
+
+    def sign(self, url, nonce, payload):
+        """Return the serialised JWS body for a request."""
+        protected = f'{{"alg":"ES256","nonce":{json.dumps(nonce)},"url":{json.dumps(url)},{self._key_header}}}'
+        protected_b64 = base64url_encode(protected)
+
+        if payload is None:
+            payload_b64 = ''
+        else:
+            payload_b64 = base64url_encode(json.dumps(payload, separators=(',', ':')))
 
-    jwk_json = json.dumps(jwk, sort_keys=True, separators=(',', ':'))
-    return base64url_encode(hashlib.sha256(jwk_json.encode()).digest())
+        # Sign, then convert DER signature to raw r||s format
+        signature = self.key.sign(f"{protected_b64}.{payload_b64}".encode(), self._algorithm)
+        r, s = self._decode_signature(signature)
+        signature_b64 = base64url_encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))
 
+        return (
+            f'{{"protected":"{protected_b64}","payload":"{payload_b64}",'
+            f'"signature":"{signature_b64}"}}'
+        ).encode()
 
-def acme_register(url, key, nonce):
-    """Register or retrieve existing ACME account."""
-    payload = {'termsOfServiceAgreed': True}
-    response, new_nonce = acme_request(url, key, None, nonce, payload)
-    account_url = response['headers'].get('Location')
-    return account_url, new_nonce
 
+class NoncePool:
+    """Small pool of fresh ACME nonces, replenished from every response.
 
-def acme_request(url, key, account_url, nonce, payload):
-    """Make a signed ACME request."""
-    from cryptography.hazmat.primitives.asymmetric import ec
-    from cryptography.hazmat.primitives import hashes
+    deque append/pop are atomic, so the pool can be shared between threads.
+    """
 
-    public_key = key.public_key()
-    numbers = public_key.public_numbers()
+    def __init__(self, new_nonce_url, size=NONCE_POOL_SIZE):
+        self.new_nonce_url = new_nonce_url
+        self._nonces = collections.deque(maxlen=size)
 
-    # Build JWK for header
-    x = numbers.x.to_bytes(32, 'big')
-    y = numbers.y.to_bytes(32, 'big')
-    jwk = {
-        'crv': 'P-256',
-        'kty': 'EC',
-        'x': base64url_encode(x),
-        'y': base64url_encode(y)
-    }
+    def add(self, nonce):
+        if nonce:
+            self._nonces.append(nonce)
 
-    # Build protected header
-    protected = {
-        'alg': 'ES256',
-        'nonce': nonce,
-        'url': url
-    }
+    def get(self):
+        """Return the newest unused nonce, fetching one if the pool is empty."""
+        try:
+            return self._nonces.pop()
+        except IndexError:
+            return fetch_url(self.new_nonce_url, method='HEAD', return_headers=True)['Replay-Nonce']
 
-    if account_url:
-        protected['kid'] = account_url
-    else:
-        protected['jwk'] = jwk
 
-    protected_b64 = base64url_encode(json.dumps(protected))
+def acme_register(url, signer, nonces):
+    """Register or retrieve existing ACME account."""
+    payload = {'termsOfServiceAgreed': True}
+    response = acme_request(url, signer, nonces, payload)
+    account_url = response['headers'].get('Location')
+    signer.set_kid(account_url)
+    return account_url
+
+
+def acme_request(url, signer, nonces, payload):
+    """Make a signed ACME request.
+
+    Retries transparently on badNonce errors and on 429/503 responses with a
+    short Retry-After.
+    """
+    for attempt in range(ACME_MAX_ATTEMPTS):
+        status, headers, body = http_request(
+            url,
+            method='POST',
+            data=signer.sign(url, nonces.get(), payload),
+            headers={'Content-Type': 'application/jose+json'}
+        )
 
-    if payload is None:
-        payload_b64 = ''
-    else:
-        payload_b64 = base64url_encode(json.dumps(payload))
+        # Every response, including errors, carries a fresh nonce
+        nonces.add(headers.get('Replay-Nonce'))
 
-    # Sign
-    signing_input = f"{protected_b64}.{payload_b64}".encode()
-    signature = key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+        if status < 400:
+            return {'body': body, 'headers': headers}
 
-    # Convert DER signature to raw r||s format
-    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
-    r, s = decode_dss_signature(signature)
-    signature_bytes = r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+        if attempt + 1 < ACME_MAX_ATTEMPTS:
+            if status == 400 and acme_error_type(body) == 'urn:ietf:params:acme:error:badNonce':
+                log('WARNING', 'Retrying ACME request after badNonce', url=url)
+                _metrics.count('AcmeRetries')
+                continue
 
-    jws = {
-        'protected': protected_b64,
-        'payload': payload_b64,
-        'signature': base64url_encode(signature_bytes)
-    }
+            delay = retry_after(headers, None)
+            if status in (429, 503) and delay is not None and delay <= ACME_MAX_RETRY_DELAY:
+                log('WARNING', 'Retrying ACME request', url=url, status=status, delay=delay)
+                _metrics.count('AcmeRetries')
+                sleep(delay)
+                continue
 
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(jws).encode(),
-        headers={'Content-Type': 'application/jose+json'},
-        method='POST'
-    )
+        raise Exception(f"ACME error {status}: {body}")
 
+
+def acme_error_type(body):
+    """Return the problem type of an ACME error response, if any."""
     try:
-        with urllib.request.urlopen(req) as response:
-            return {
-                'body': response.read().decode(),
-                'headers': dict(response.headers)
-            }, response.headers.get('Replay-Nonce')
-    except urllib.error.HTTPError as e:
-        body = e.read().decode()
-        # Return nonce even on error for retry
-        new_nonce = e.headers.get('Replay-Nonce', nonce)
-        raise Exception(f"ACME error {e.code}: {body}")
+        return json.loads(body).get('type')
+    except (ValueError, AttributeError):
+        return None
@@ -0,0 +1,275 @@
+"""Offline benchmarks for cert-lambda.py.
+
+issuance (default): wall time, CPU, requests and sleeps per phase for full
+issuances against the fakes in fakes.py: one uninterrupted, one with the
+per-name ACME requests made one at a time (ACME_CONCURRENCY=1), and one
+suspended while Route 53 is still applying the change, then resumed.
+Backoff delays are scaled by --time-scale (default 0.01), so sleep times are
+reported both as slept and as they would be at full scale.
+
+signer: AcmeSigner.sign against rebuilding the JWK and header for every
+request, as acme_request did before the signer existed.
+
+auth: authorized() with two configured tokens against hashing the configured
+tokens again on every request.
+
+clients: creating a boto3 client for every call against the warm
+get_client() lookup the function uses. No requests are sent.
+
+    python bench.py [issuance] [--runs 5] [--key-type rsa-2048] [--pending-polls 2]
+                    [--dns-lag 1] [--acme-latency-ms 20]
+    python bench.py signer [--number 2000]
+    python bench.py auth [--number 2000]
+    python bench.py clients [--number 2000]
+"""
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import statistics
+import time
+import timeit
+
+from fakes import Context, Environment, load_cert_lambda, metrics_line
+
+DOMAINS = ['home.example.com', '*.example.com', 'example.com', 'www.example.org', 'api.example.net']
+ZONES = ['example.com', 'example.org', 'example.net']
+
+
+class Probe:
+    """Wraps a loaded module's metrics to also record CPU time per phase and sleeps."""
+
+    def __init__(self, module):
+        self.cpu = collections.Counter()
+        self.sleeps = []
+        metrics = module._metrics
+        phase = metrics.phase
+        sleep = module.sleep
+
+        @contextlib.contextmanager
+        def timed_phase(name):
+            start = time.process_time()
+            try:
+                with phase(name):
+                    yield
+            finally:
+                self.cpu[name] += time.process_time() - start
+
+        def recorded_sleep(seconds):
+            self.sleeps.append(seconds)
+            sleep(seconds)
+
+        metrics.phase = timed_phase
+        module.sleep = recorded_sleep
+
+
+def run_scenario(args, suspend=False, concurrency=None):
+    """Run one issuance and return its measurements."""
+    env = Environment(
+        DOMAINS, ZONES, env={'CERT_KEY_TYPE': args.key_type},
+        pending_polls=10**6 if suspend else args.pending_polls,
+        dns_lag=args.dns_lag, time_scale=args.time_scale, processing_polls=args.processing_polls,
+        latency=args.acme_latency_ms / 1000
+    )
+    with env:
+        if concurrency:
+            env.module.ACME_CONCURRENCY = concurrency
+        probe = Probe(env.module)
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        metrics = []
+        if suspend:
+            result, lines = env.invoke({}, Context(seconds=1.5))
+            assert result['statusCode'] == 202, result
+            metrics.append(metrics_line(lines))
+            env.route53.changes = dict.fromkeys(env.route53.changes, args.pending_polls)
+        result, lines = env.invoke({'resume': True} if suspend else {})
+        assert result['statusCode'] == 200, result
+        metrics.append(metrics_line(lines))
+
+        return {
+            'wall': time.perf_counter() - wall_start,
+            'cpu': time.process_time() - cpu_start,
+            'phases': {
+                name: sum(m[f"{''.join(part.title() for part in name.split('_'))}Time"] for m in metrics) / 1000
+                for name in env.module.IssuanceMetrics.PHASES
+            },
+            'phase_cpu': dict(probe.cpu),
+            'sleeps': len(probe.sleeps),
+            'slept': sum(probe.sleeps),
+            'http': sum(m['HttpRequests'] for m in metrics),
+            'acme': dict(env.acme.requests),
+            'connections': env.acme.connections,
+            'route53': collections.Counter(env.route53.calls),
+            'secrets': collections.Counter(call for call, _ in env.secrets.calls),
+            'dns_queries': env.dns.queries,
+            'invocations': len(metrics),
+        }
+
+
+def report(title, runs, time_scale):
+    def median(key, sub=None):
+        values = [run[key].get(sub, 0) if sub else run[key] for run in runs]
+        return statistics.median(values)
+
+    print(f"\n{title} ({len(runs)} runs, medians)")
+    print(f"  {'phase':<14}{'wall ms':>10}{'cpu ms':>10}")
+    for name in runs[0]['phases']:
+        print(f"  {name:<14}{median('phases', name) * 1000:>10.1f}{median('phase_cpu', name) * 1000:>10.1f}")
+    print(f"  {'total':<14}{median('wall') * 1000:>10.1f}{median('cpu') * 1000:>10.1f}")
+
+    print(f"  invocations      {median('invocations'):g}")
+    print(f"  sleeps           {median('sleeps'):g} calls, {median('slept') * 1000:.1f} ms slept"
+          f" ({median('slept') / time_scale:.1f} s at full scale)")
+    print(f"  HTTP requests    {median('http'):g} over {median('connections'):g} connections")
+    acme = collections.Counter()
+    for run in runs:
+        acme.update(run['acme'])
+    print('  ACME requests    ' + ', '.join(f"{name} {count / len(runs):g}" for name, count in sorted(acme.items())))
+    route53 = collections.Counter()
+    secrets = collections.Counter()
+    for run in runs:
+        route53.update(run['route53'])
+        secrets.update(run['secrets'])
+    print('  Route 53 calls   ' + ', '.join(f"{name} {count / len(runs):g}" for name, count in sorted(route53.items())))
+    print('  Secrets calls    ' + ', '.join(f"{name} {count / len(runs):g}" for name, count in sorted(secrets.items())))
+    print(f"  DNS queries      {median('dns_queries'):g}")
+
+
+def per_call(func, number):
+    """Best of five timings of func, in microseconds per call."""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def rebuilt_jws(module, key, url, account_url, nonce, payload):
+    """Sign a request the way acme_request did before AcmeSigner: everything per call."""
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+    numbers = key.public_key().public_numbers()
+    jwk = {
+        'crv': 'P-256',
+        'kty': 'EC',
+        'x': module.base64url_encode(numbers.x.to_bytes(32, 'big')),
+        'y': module.base64url_encode(numbers.y.to_bytes(32, 'big'))
+    }
+    protected = {'alg': 'ES256', 'nonce': nonce, 'url': url}
+    if account_url:
+        protected['kid'] = account_url
+    else:
+        protected['jwk'] = jwk
+    protected_b64 = module.base64url_encode(json.dumps(protected))
+    payload_b64 = '' if payload is None else module.base64url_encode(json.dumps(payload))
+
+    signature = key.sign(f"{protected_b64}.{payload_b64}".encode(), ec.ECDSA(hashes.SHA256()))
+    r, s = decode_dss_signature(signature)
+    return json.dumps({
+        'protected': protected_b64,
+        'payload': payload_b64,
+        'signature': module.base64url_encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))
+    }).encode()
+
+
+def bench_signer(args):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    module = load_cert_lambda()
+    key = ec.generate_private_key(ec.SECP256R1())
+    url = 'https://acme.example/acme/authz/1234567890'
+    account_url = 'https://acme.example/acme/acct/123456'
+    nonce = 'oFvnlFP1wIhRlYS2jTaXbA'
+    signer = module.AcmeSigner(key)
+    signer.set_kid(account_url)
+    algorithm = ec.ECDSA(hashes.SHA256())
+
+    ecdsa = per_call(lambda: key.sign(b'x' * 200, algorithm), args.number)
+    results = [
+        ('ECDSA signature alone', ecdsa),
+        ('rebuilt JWK per request', per_call(
+            lambda: rebuilt_jws(module, key, url, account_url, nonce, None), args.number)),
+        ('AcmeSigner.sign', per_call(lambda: signer.sign(url, nonce, None), args.number)),
+    ]
+    print(f"Signing a POST-as-GET request ({args.number} calls, best of 5)")
+    print(f"  {'':<26}{'us/call':>10}{'overhead':>10}")
+    for name, micros in results:
+        print(f"  {name:<26}{micros:>10.1f}{micros - ecdsa:>10.1f}")
+
+
+def bench_auth(args):
+    module = load_cert_lambda()
+    tokens = 'first-token, sha256:' + hashlib.sha256(b'second-token').hexdigest()
+    os.environ['CERT_TOKEN'] = tokens
+
+    def rehashed(auth_header):
+        module._token_digests = None
+        return module.authorized(auth_header)
+
+    results = [
+        ('valid token', per_call(lambda: module.authorized('Bearer second-token'), args.number)),
+        ('wrong token', per_call(lambda: module.authorized('Bearer wrong-token'), args.number)),
+        ('tokens hashed per request', per_call(lambda: rehashed('Bearer second-token'), args.number)),
+    ]
+    print(f"authorized() with two tokens ({args.number} calls, best of 5)")
+    for name, micros in results:
+        print(f"  {name:<28}{micros:>8.2f} us/call")
+
+
+def bench_clients(args):
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    module = load_cert_lambda()
+    service = 'secretsmanager'
+
+    start = time.perf_counter()
+    module.get_client(service)
+    first = (time.perf_counter() - start) * 1e6
+    # Client construction takes milliseconds, so fewer calls are enough
+    number = max(1, args.number // 100)
+    results = [
+        ('first get_client()', first),
+        ('boto3.client() per call', per_call(
+            lambda: module.boto3.client(service, config=module.CLIENT_CONFIG), number)),
+        ('warm get_client()', per_call(lambda: module.get_client(service), args.number)),
+    ]
+    print(f"{service} client (best of 5)")
+    for name, micros in results:
+        print(f"  {name:<26}{micros:>10.1f} us/call")
+
+
+def bench_issuance(args):
+    print(f"{len(DOMAINS)} names in {len(ZONES)} zones, {args.key_type} key, "
+          f"{args.acme_latency_ms:g} ms per CA round trip")
+    report('Full issuance', [run_scenario(args) for _ in range(args.runs)], args.time_scale)
+    report('Full issuance, ACME_CONCURRENCY=1',
+           [run_scenario(args, concurrency=1) for _ in range(args.runs)], args.time_scale)
+    report('Suspended and resumed', [run_scenario(args, suspend=True) for _ in range(args.runs)], args.time_scale)
+
+
+BENCHMARKS = {'issuance': bench_issuance, 'signer': bench_signer, 'auth': bench_auth,
+              'clients': bench_clients}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', nargs='?', default='issuance', choices=BENCHMARKS)
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing in microbenchmarks')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--key-type', default='rsa-2048')
+    parser.add_argument('--pending-polls', type=int, default=2, help='get_change calls before INSYNC')
+    parser.add_argument('--dns-lag', type=int, default=1, help='queries per name before the stub answers')
+    parser.add_argument('--processing-polls', type=int, default=1, help='ACME polls before valid')
+    parser.add_argument('--time-scale', type=float, default=0.01, help='factor applied to backoff delays')
+    parser.add_argument('--acme-latency-ms', type=float, default=20, help='delay of every fake CA response')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Serve one GET /cert from a cold interpreter and report what it loaded.
+
+Run by test_api.ColdStartTest in a subprocess (optionally with -X importtime).
+Only the standard library, boto3 and botocore are imported here, so anything
+else in sys.modules was pulled in by cert-lambda.py on the API path. The
+secret comes from CERT_SECRET_STRING through a stubbed Secrets Manager client.
+Prints one JSON line: the response status, the boto3 service models loaded
+and any cryptography modules imported.
+"""
+
+import datetime
+import importlib.util
+import json
+import os
+import sys
+
+import botocore.loaders
+
+services = []
+load_service_model = botocore.loaders.Loader.load_service_model
+
+
+def recording_load_service_model(self, service_name, type_name, api_version=None):
+    services.append(service_name)
+    return load_service_model(self, service_name, type_name, api_version)
+
+
+botocore.loaders.Loader.load_service_model = recording_load_service_model
+
+spec = importlib.util.spec_from_file_location('cert_lambda', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+from botocore.stub import Stubber  # noqa: E402 - after the cold import on purpose
+
+stubber = Stubber(module.get_client('secretsmanager'))
+stubber.add_response('get_secret_value', {
+    'ARN': os.environ['CERT_SECRET_ARN'],
+    'Name': 'cert',
+    'VersionId': 'a' * 32,
+    'SecretString': os.environ['CERT_SECRET_STRING'],
+    'VersionStages': ['AWSCURRENT'],
+    'CreatedDate': datetime.datetime.now(datetime.timezone.utc),
+})
+stubber.activate()
+
+
+class Context:
+    aws_request_id = 'cold-start'
+
+
+response = module.handler({
+    'rawPath': '/cert',
+    'headers': {'authorization': f"Bearer {os.environ['CERT_TOKEN']}"},
+    'requestContext': {'http': {'method': 'GET', 'path': '/cert', 'sourceIp': '192.0.2.1'}},
+}, Context())
+
+print(json.dumps({
+    'status': response['statusCode'],
+    'services': sorted(set(services)),
+    'cryptography': sorted(name for name in sys.modules if name.split('.')[0] == 'cryptography'),
+}))
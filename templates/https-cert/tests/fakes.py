@@ -0,0 +1,598 @@
+"""Offline stand-ins for everything cert-lambda.py talks to.
+
+A fake ACME CA (http.server), a UDP DNS stub serving the fake Route 53
+records, and fake Route 53, Secrets Manager, Lambda and SNS clients. The
+function under test is loaded fresh with load_cert_lambda() and the fakes
+are injected through its _clients cache, so no AWS credentials or network
+access are needed.
+"""
+
+import base64
+import contextlib
+import datetime
+import hashlib
+import http.server
+import importlib.util
+import io
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+CERT_LAMBDA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cert-lambda.py')
+_loaded = itertools.count()
+
+
+def client_error(code, operation):
+    """Build the botocore error a real client raises for an error code."""
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def b64decode(value):
+    """Decode unpadded base64url."""
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def b64encode(data):
+    """Encode as unpadded base64url."""
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class FakeRoute53:
+    """Public hosted zones holding TXT records in memory.
+
+    Changes stay PENDING for pending_polls get_change calls before they are
+    INSYNC. Every nameserver of every zone is 127.0.0.1, where FakeDns answers.
+    """
+
+    def __init__(self, zones, pending_polls=0):
+        self.zones = {name.rstrip('.') + '.': f'Z{i}' for i, name in enumerate(zones, 1)}
+        self.records = {}
+        self.pending_polls = pending_polls
+        self.changes = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def list_hosted_zones_by_name(self, DNSName, **kwargs):
+        self.calls.append('list_hosted_zones_by_name')
+        # Zones are listed in order of their reversed labels, starting at DNSName
+        def order(name):
+            return name.rstrip('.').split('.')[::-1]
+
+        return {'HostedZones': [
+            {'Name': name, 'Id': f'/hostedzone/{zone_id}', 'Config': {'PrivateZone': False}}
+            for name, zone_id in sorted(self.zones.items(), key=lambda zone: order(zone[0]))
+            if order(name) >= order(DNSName)
+        ]}
+
+    def get_hosted_zone(self, Id):
+        self.calls.append('get_hosted_zone')
+        return {'HostedZone': {'Id': Id}, 'DelegationSet': {'NameServers': ['127.0.0.1']}}
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.calls.append('change_resource_record_sets')
+        zone_name = next(name for name, zone_id in self.zones.items() if zone_id == HostedZoneId)
+        with self._lock:
+            for change in ChangeBatch['Changes']:
+                record = change['ResourceRecordSet']
+                name = record['Name'].rstrip('.').lower()
+                if not (name + '.').endswith('.' + zone_name) and name + '.' != zone_name:
+                    raise client_error('InvalidChangeBatch', 'ChangeResourceRecordSets')
+                if change['Action'] == 'DELETE':
+                    self.records.pop(name, None)
+                else:
+                    self.records[name] = [value['Value'].strip('"') for value in record['ResourceRecords']]
+            change_id = f'/change/C{uuid.uuid4().hex[:12].upper()}'
+            self.changes[change_id] = self.pending_polls
+        return {'ChangeInfo': {'Id': change_id, 'Status': 'PENDING'}}
+
+    def get_change(self, Id):
+        self.calls.append('get_change')
+        with self._lock:
+            remaining = self.changes[Id]
+            if remaining:
+                self.changes[Id] = remaining - 1
+        return {'ChangeInfo': {'Id': Id, 'Status': 'PENDING' if remaining else 'INSYNC'}}
+
+    def txt_values(self, name):
+        return list(self.records.get(name.rstrip('.').lower(), []))
+
+
+class FakeSecretsManager:
+    """Versioned secrets with AWSCURRENT/AWSPREVIOUS stages.
+
+    ClientRequestToken works like the real service: reusing a token with the
+    same content is a no-op, with different content ResourceExistsException.
+    """
+
+    def __init__(self, secrets=()):
+        self.versions = {}
+        self.calls = []
+        for secret_id in secrets:
+            self.put_secret_value(SecretId=secret_id, SecretString='{}')
+        self.calls.clear()
+
+    def get_secret_value(self, SecretId, VersionStage='AWSCURRENT', **kwargs):
+        self.calls.append(('get_secret_value', SecretId))
+        for version in reversed(self.versions.get(SecretId, [])):
+            if VersionStage in version['stages']:
+                return {
+                    'ARN': SecretId,
+                    'VersionId': version['VersionId'],
+                    'SecretString': version['SecretString'],
+                    'VersionStages': list(version['stages']),
+                    'CreatedDate': version['CreatedDate'],
+                }
+        raise client_error('ResourceNotFoundException', 'GetSecretValue')
+
+    def put_secret_value(self, SecretId, SecretString, ClientRequestToken=None, VersionStages=None):
+        self.calls.append(('put_secret_value', SecretId))
+        versions = self.versions.setdefault(SecretId, [])
+        version_id = ClientRequestToken or str(uuid.uuid4())
+        for version in versions:
+            if version['VersionId'] == version_id:
+                if version['SecretString'] != SecretString:
+                    raise client_error('ResourceExistsException', 'PutSecretValue')
+                return {'ARN': SecretId, 'VersionId': version_id}
+
+        for version in versions:
+            version['stages'].discard('AWSPREVIOUS')
+            if 'AWSCURRENT' in version['stages']:
+                version['stages'].discard('AWSCURRENT')
+                version['stages'].add('AWSPREVIOUS')
+        versions.append({
+            'VersionId': version_id,
+            'SecretString': SecretString,
+            'stages': set(VersionStages or ['AWSCURRENT']),
+            'CreatedDate': datetime.datetime.now(datetime.timezone.utc),
+        })
+        return {'ARN': SecretId, 'VersionId': version_id}
+
+    def current(self, secret_id):
+        """Return the parsed AWSCURRENT value of a secret."""
+        return json.loads(self.get_secret_value(SecretId=secret_id)['SecretString'])
+
+    def put_count(self, secret_id):
+        return self.calls.count(('put_secret_value', secret_id))
+
+
+class FakeLambda:
+    """Records self-invocations made when an issuance is suspended."""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+
+class FakeSns:
+    """Records rotation notifications."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, **kwargs):
+        self.messages.append(kwargs)
+        return {'MessageId': str(uuid.uuid4())}
+
+
+class FakeDns:
+    """UDP nameserver on 127.0.0.1 answering TXT queries from a FakeRoute53.
+
+    A record becomes visible after lag_queries queries for its name, to mimic
+    an edge that has not picked up a change yet.
+    """
+
+    def __init__(self, route53, lag_queries=0):
+        self.route53 = route53
+        self.lag_queries = lag_queries
+        self.queries = 0
+        self._seen = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                query, address = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            offset = 12
+            labels = []
+            while query[offset]:
+                labels.append(query[offset + 1:offset + 1 + query[offset]].decode())
+                offset += query[offset] + 1
+            question = query[12:offset + 5]
+            name = '.'.join(labels).lower()
+
+            self._seen[name] = self._seen.get(name, 0) + 1
+            values = self.route53.txt_values(name) if self._seen[name] > self.lag_queries else []
+            answers = b''
+            for value in values:
+                data = bytes([len(value)]) + value.encode()
+                answers += b'\xc0\x0c' + struct.pack('>HHIH', 16, 1, 60, len(data)) + data
+            header = query[:2] + struct.pack('>HHHHH', 0x8400, 1, len(values), 0, 0)
+            self.sock.sendto(header + question + answers, address)
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeAcme:
+    """Minimal ACME CA (RFC 8555) over plain HTTP on 127.0.0.1.
+
+    DNS-01 challenges are checked against the FakeDns server. Options:
+    authz_valid issues orders whose authorizations are already valid,
+    processing_polls keeps answered authorizations and finalized orders
+    pending/processing for that many polls, bad_nonces rejects that many
+    requests with badNonce, and latency (seconds) delays every response like
+    the round trip to a remote CA.
+    """
+
+    def __init__(self, dns_port, authz_valid=False, processing_polls=0, bad_nonces=0, latency=0):
+        self.dns_port = dns_port
+        self.latency = latency
+        self.authz_valid = authz_valid
+        self.processing_polls = processing_polls
+        self.bad_nonces = bad_nonces
+        self.requests = {}
+        self.connections = 0
+        self.orders = {}
+        self.authorizations = {}
+        self.certificates = {}
+        self.accounts = {}
+        self._lock = threading.Lock()
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.ca_key = ec.generate_private_key(ec.SECP256R1())
+        self.ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Fake ACME CA')])
+        self.ca_cert = x509.CertificateBuilder().subject_name(self.ca_name).issuer_name(
+            self.ca_name).public_key(self.ca_key.public_key()).serial_number(1).not_valid_before(
+            now).not_valid_after(now + datetime.timedelta(days=3650)).sign(self.ca_key, hashes.SHA256())
+
+        acme = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send each response in one segment, so delayed ACKs don't add
+            # 40 ms to every keep-alive request
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                with acme._lock:
+                    acme.connections += 1
+                super().setup()
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                acme.count('newNonce')
+                self.reply(200)
+
+            def do_GET(self):
+                acme.count('directory')
+                if self.path == '/directory':
+                    self.reply(200, acme.directory())
+                else:
+                    self.reply(404, {'type': 'urn:ietf:params:acme:error:malformed'})
+
+            def do_POST(self):
+                jws = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status, body, headers = acme.handle(self.path, jws)
+                self.reply(status, body, headers)
+
+            def reply(self, status, body=b'', headers=None):
+                time.sleep(acme.latency)
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body)
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(status)
+                self.send_header('Replay-Nonce', uuid.uuid4().hex)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def directory_url(self):
+        return f'{self.base}/directory'
+
+    def directory(self):
+        return {
+            'newNonce': f'{self.base}/nonce',
+            'newAccount': f'{self.base}/account',
+            'newOrder': f'{self.base}/order',
+        }
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def handle(self, path, jws):
+        """Dispatch a signed POST. Returns (status, body, headers)."""
+        kind = path.strip('/').split('/')[0]
+        self.count(kind)
+        protected = json.loads(b64decode(jws['protected']))
+        payload = json.loads(b64decode(jws['payload'])) if jws['payload'] else None
+
+        with self._lock:
+            if self.bad_nonces:
+                self.bad_nonces -= 1
+                return 400, {'type': 'urn:ietf:params:acme:error:badNonce'}, {}
+
+        if kind == 'account':
+            for account_url, jwk in self.accounts.items():
+                if jwk == protected['jwk']:
+                    return 200, {'status': 'valid'}, {'Location': account_url}
+            account_url = f'{self.base}/account/{len(self.accounts) + 1}'
+            self.accounts[account_url] = protected['jwk']
+            return 201, {'status': 'valid'}, {'Location': account_url}
+        if kind == 'order' and path == '/order':
+            return self.new_order(payload)
+
+        object_id = path.rstrip('/').split('/')[-1]
+        if kind == 'authz':
+            return self.poll_authorization(object_id)
+        if kind == 'challenge':
+            return self.answer_challenge(object_id, protected)
+        if kind == 'order':
+            return self.poll_order(object_id)
+        if kind == 'finalize':
+            return self.finalize(object_id, payload)
+        if kind == 'cert':
+            return 200, self.certificates[object_id], {'Content-Type': 'application/pem-certificate-chain'}
+        return 404, {'type': 'urn:ietf:params:acme:error:malformed'}, {}
+
+    def new_order(self, payload):
+        order_id = uuid.uuid4().hex[:12]
+        authorizations = []
+        for identifier in payload['identifiers']:
+            authz_id = uuid.uuid4().hex[:12]
+            name = identifier['value']
+            wildcard = name.startswith('*.')
+            self.authorizations[authz_id] = {
+                'identifier': {'type': 'dns', 'value': name[2:] if wildcard else name},
+                'status': 'valid' if self.authz_valid else 'pending',
+                'wildcard': wildcard,
+                'challenges': [{
+                    'type': 'dns-01',
+                    'url': f'{self.base}/challenge/{authz_id}',
+                    'token': b64encode(os.urandom(24)),
+                    'status': 'pending'
+                }],
+                'polls': 0,
+            }
+            authorizations.append(f'{self.base}/authz/{authz_id}')
+
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7)
+        self.orders[order_id] = {
+            'status': 'ready' if self.authz_valid else 'pending',
+            'expires': expires.isoformat(),
+            'identifiers': payload['identifiers'],
+            'authorizations': authorizations,
+            'finalize': f'{self.base}/finalize/{order_id}',
+            'polls': 0,
+        }
+        return 201, self.public(self.orders[order_id]), {'Location': f'{self.base}/order/{order_id}'}
+
+    def answer_challenge(self, authz_id, protected):
+        """Check the TXT value for a challenge on the DNS stub, like a real CA."""
+        authz = self.authorizations[authz_id]
+        challenge = authz['challenges'][0]
+        jwk = json.dumps(self.accounts[protected['kid']], sort_keys=True, separators=(',', ':'))
+        thumbprint = b64encode(hashlib.sha256(jwk.encode()).digest())
+        expected = b64encode(hashlib.sha256(f"{challenge['token']}.{thumbprint}".encode()).digest())
+
+        txt_name = f"_acme-challenge.{authz['identifier']['value']}"
+        if expected in dns_query_txt(txt_name, self.dns_port):
+            challenge['status'] = 'processing'
+        else:
+            challenge['status'] = authz['status'] = 'invalid'
+        return 200, challenge, {'Link': f'<{self.base}/authz/{authz_id}>;rel="up"'}
+
+    def poll_authorization(self, authz_id):
+        authz = self.authorizations[authz_id]
+        if authz['challenges'][0]['status'] == 'processing':
+            authz['polls'] += 1
+            if authz['polls'] > self.processing_polls:
+                authz['status'] = 'valid'
+                authz['challenges'][0]['status'] = 'valid'
+        return 200, self.public(authz), {'Retry-After': '0'}
+
+    def poll_order(self, order_id):
+        order = self.orders[order_id]
+        if order['status'] == 'pending':
+            statuses = [self.authorizations[url.rsplit('/', 1)[1]]['status'] for url in order['authorizations']]
+            if 'invalid' in statuses:
+                order['status'] = 'invalid'
+            elif all(status == 'valid' for status in statuses):
+                order['status'] = 'ready'
+        elif order['status'] == 'processing':
+            order['polls'] += 1
+            if order['polls'] > self.processing_polls:
+                order.update(status='valid', certificate=f'{self.base}/cert/{order_id}')
+        return 200, self.public(order), {'Retry-After': '0'}
+
+    def finalize(self, order_id, payload):
+        order = self.orders[order_id]
+        if order['status'] != 'ready':
+            return 403, {'type': 'urn:ietf:params:acme:error:orderNotReady'}, {}
+
+        csr = x509.load_der_x509_csr(b64decode(payload['csr']))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        names = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        cert = x509.CertificateBuilder().subject_name(csr.subject).issuer_name(self.ca_name).public_key(
+            csr.public_key()).serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(
+            now + datetime.timedelta(days=90)).add_extension(names, critical=False).sign(self.ca_key, hashes.SHA256())
+        self.certificates[order_id] = (
+            cert.public_bytes(serialization.Encoding.PEM) + self.ca_cert.public_bytes(serialization.Encoding.PEM)
+        ).decode()
+
+        if self.processing_polls:
+            order['status'] = 'processing'
+        else:
+            order.update(status='valid', certificate=f'{self.base}/cert/{order_id}')
+        return 200, self.public(order), {'Location': f'{self.base}/order/{order_id}'}
+
+    @staticmethod
+    def public(resource):
+        """Drop the bookkeeping fields a real CA would not return."""
+        return {key: value for key, value in resource.items() if key != 'polls'}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def dns_query_txt(name, port):
+    """Look up TXT values on the local DNS stub, as the CA's validator does."""
+    question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\0'
+    packet = struct.pack('>HHHHHH', 1, 0, 1, 0, 0, 0) + question + struct.pack('>HH', 16, 1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.sendto(packet, ('127.0.0.1', port))
+        response, _ = sock.recvfrom(4096)
+
+    count = struct.unpack('>H', response[6:8])[0]
+    offset = 12 + len(question) + 4
+    values = set()
+    for _ in range(count):
+        offset += 2
+        _, _, _, length = struct.unpack('>HHIH', response[offset:offset + 10])
+        offset += 10
+        values.add(response[offset + 1:offset + length].decode())
+        offset += length
+    return values
+
+
+class Context:
+    """Lambda context whose remaining time runs down in real time."""
+
+    def __init__(self, seconds=300):
+        self.deadline = time.monotonic() + seconds
+        self.aws_request_id = str(uuid.uuid4())
+        self.invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:cert'
+        self.log_stream_name = 'test'
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.deadline - time.monotonic()) * 1000), 0)
+
+
+class Environment:
+    """The fakes for one scenario, wired to a freshly loaded cert-lambda module.
+
+    Backoff delays are scaled by time_scale and RESUME_MARGIN is set to
+    resume_margin seconds, so waits and suspensions take a fraction of the
+    real time. Call close() (or use as a context manager) to stop the servers.
+    """
+
+    SECRETS = {'CERT_SECRET_ARN': 'cert', 'STATE_SECRET_ARN': 'state', 'ACCOUNT_SECRET_ARN': 'account'}
+
+    def __init__(self, domains, zones, env=None, pending_polls=0, dns_lag=0, time_scale=0.01,
+                 resume_margin=0.5, **acme_options):
+        self.route53 = FakeRoute53(zones, pending_polls)
+        self.secrets = FakeSecretsManager(self.SECRETS.values())
+        self.lambda_client = FakeLambda()
+        self.sns = FakeSns()
+        self.dns = FakeDns(self.route53, dns_lag)
+        self.acme = FakeAcme(self.dns.port, **acme_options)
+
+        self.env = {
+            'DOMAIN': domains[0],
+            'ADDITIONAL_NAMES': ','.join(domains[1:]),
+            'CERT_KEY_TYPE': 'ec-p256',
+            'CERT_TOKEN': 'test-token',
+            'ROTATION_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:rotation',
+            'ACME_DIRECTORY': self.acme.directory_url,
+            'DNS_PORT': str(self.dns.port),
+            **self.SECRETS,
+            **(env or {}),
+        }
+        self._env_patch = mock.patch.dict(os.environ, self.env)
+        self._env_patch.start()
+        self.module = load_cert_lambda(time_scale)
+        self.module.RESUME_MARGIN = resume_margin
+        self.module._clients.update({
+            'route53': self.route53,
+            'secretsmanager': self.secrets,
+            'lambda': self.lambda_client,
+            'sns': self.sns,
+        })
+
+    def invoke(self, event, context=None):
+        """Call the handler. Returns (result, parsed JSON log lines).
+
+        The log lines are also kept in self.lines, for runs that raise.
+        """
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                result = self.module.handler(event, context or Context())
+        finally:
+            self.lines = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{')]
+        return result, self.lines
+
+    def close(self):
+        for connections in self.module._connections.values():
+            for connection in connections:
+                connection.close()
+        self.acme.close()
+        self.dns.close()
+        self._env_patch.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_cert_lambda(time_scale=1.0):
+    """Import a fresh copy of cert-lambda.py with the current environment."""
+    spec = importlib.util.spec_from_file_location(f'cert_lambda_{next(_loaded)}', CERT_LAMBDA)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if time_scale != 1.0:
+        backoff_delays = module.backoff_delays
+
+        def scaled_backoff_delays(timeout, initial=1, maximum=10):
+            return backoff_delays(timeout, initial * time_scale, maximum * time_scale)
+
+        module.backoff_delays = scaled_backoff_delays
+    return module
+
+
+def metrics_line(lines):
+    """Return the EMF metrics log line from a run's output."""
+    return next(line for line in lines if '_aws' in line)
@@ -0,0 +1,216 @@
+"""GET /cert and GET /cert/meta against a certificate issued by the fake CA."""
+
+import base64
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+from fakes import CERT_LAMBDA, Environment
+
+TOKEN = 'test-token'
+
+# Import time allowed for a cold GET /cert: loading cert-lambda.py, creating
+# the Secrets Manager client and serving the request (about 0.2 s locally)
+COLD_START_IMPORT_BUDGET_MS = 500
+
+
+def api_event(path='/cert', token=TOKEN, ip='192.0.2.1', query=None, **headers):
+    headers = {name.replace('_', '-'): value for name, value in headers.items()}
+    if token is not None:
+        headers['authorization'] = f'Bearer {token}'
+    return {
+        'rawPath': path,
+        'headers': headers,
+        'queryStringParameters': query,
+        'requestContext': {'http': {'method': 'GET', 'path': path, 'sourceIp': ip}},
+    }
+
+
+class ApiTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.env = Environment(['home.example.com'], ['example.com'], authz_valid=True)
+        cls.env.invoke({})
+        cls.stored = cls.env.secrets.current('cert')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.env.close()
+
+    def setUp(self):
+        self.env.module._auth_failures.clear()
+
+    def get(self, *args, **kwargs):
+        response, _ = self.env.invoke(api_event(*args, **kwargs))
+        return response
+
+    def test_json_hides_account_key_and_pkcs12(self):
+        response = self.get()
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual(body['certificate'], self.stored['certificate'])
+        self.assertNotIn('pkcs12', body)
+        self.assertNotIn('account_key', body)
+
+    def test_formats(self):
+        pem = self.get(query={'format': 'pem'})
+        self.assertEqual(pem['body'], self.stored['certificate'] + self.stored['chain'] + self.stored['private_key'])
+
+        der = self.get(accept='application/pkix-cert')
+        self.assertTrue(der['isBase64Encoded'])
+        self.assertEqual(hashlib.sha256(base64.b64decode(der['body'])).hexdigest(), self.stored['fingerprint'])
+
+        p12 = self.get(query={'format': 'p12'})
+        self.assertEqual(p12['body'], self.stored['pkcs12'])
+        self.assertEqual(p12['headers']['Content-Type'], 'application/x-pkcs12')
+
+        self.assertEqual(self.get(query={'format': 'nope'})['statusCode'], 400)
+
+    def test_meta(self):
+        response = self.get('/cert/meta')
+        meta = json.loads(response['body'])
+        version = self.env.secrets.get_secret_value(SecretId='cert')['VersionId']
+        self.assertEqual(meta, {
+            'fingerprint': self.stored['fingerprint'],
+            'serial': self.stored['serial'],
+            'expires': self.stored['expires'],
+            'version': version,
+        })
+        self.assertEqual(response['headers']['ETag'], f'"{self.stored["fingerprint"]}-meta"')
+
+    def test_conditional_requests(self):
+        response = self.get()
+        etag = response['headers']['ETag']
+        self.assertEqual(etag, f'"{self.stored["fingerprint"]}"')
+
+        self.assertEqual(self.get(if_none_match=etag)['statusCode'], 304)
+        self.assertEqual(self.get(if_none_match=f'W/{etag}')['statusCode'], 304)
+        self.assertEqual(self.get(if_none_match='"other"')['statusCode'], 200)
+        # Another format is another representation
+        self.assertEqual(self.get(query={'format': 'pem'}, if_none_match=etag)['statusCode'], 200)
+        last_modified = response['headers']['Last-Modified']
+        self.assertEqual(self.get(if_modified_since=last_modified)['statusCode'], 304)
+
+    def test_gzip(self):
+        response = self.get(query={'format': 'fullchain'}, accept_encoding='gzip, br')
+        self.assertEqual(response['headers']['Content-Encoding'], 'gzip')
+        self.assertTrue(response['isBase64Encoded'])
+        body = gzip.decompress(base64.b64decode(response['body'])).decode()
+        self.assertEqual(body, self.stored['certificate'] + self.stored['chain'])
+        self.assertTrue(response['headers']['ETag'].endswith('-fullchain-gzip"'))
+
+    def test_reads_secret_once_per_ttl(self):
+        self.env.module._cert_cache['refresh_at'] = 0
+        reads = self.env.secrets.calls.count(('get_secret_value', 'cert'))
+        for _ in range(5):
+            self.get()
+        self.assertEqual(self.env.secrets.calls.count(('get_secret_value', 'cert')), reads + 1)
+
+    def test_blocks_after_repeated_failures(self):
+        statuses = [self.get(token='wrong', ip='198.51.100.7')['statusCode'] for _ in range(11)]
+        self.assertEqual(statuses, [403] * 10 + [429])
+
+        # Blocked clients are refused even with the right token, without a log line
+        response, lines = self.env.invoke(api_event(ip='198.51.100.7'))
+        self.assertEqual(response['statusCode'], 429)
+        self.assertEqual(response['headers']['Retry-After'], '60')
+        self.assertEqual(lines, [])
+
+        # Other clients are unaffected
+        self.assertEqual(self.get(ip='198.51.100.8')['statusCode'], 200)
+
+    def test_missing_authorization(self):
+        self.assertEqual(self.get(token=None)['statusCode'], 403)
+
+
+class ColdStartTest(unittest.TestCase):
+    """The API path must not load cryptography or any AWS client but Secrets Manager."""
+
+    @classmethod
+    def setUpClass(cls):
+        with Environment(['home.example.com'], ['example.com'], authz_valid=True) as env:
+            env.invoke({})
+            secret_string = env.secrets.get_secret_value(SecretId='cert')['SecretString']
+
+        cls.env = {
+            'PATH': os.environ.get('PATH', ''),
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_CONFIG_FILE': os.devnull,
+            'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+            'AWS_EC2_METADATA_DISABLED': 'true',
+            'CERT_SECRET_ARN': 'arn:aws:secretsmanager:us-east-1:123456789012:secret:cert-AbCdEf',
+            'CERT_SECRET_STRING': secret_string,
+            'CERT_TOKEN': TOKEN,
+            'LOG_SAMPLE_RATE': '0',
+        }
+
+    def cold_get(self, *options):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start.py')
+        process = subprocess.run(
+            [sys.executable, *options, script, CERT_LAMBDA],
+            env=self.env, capture_output=True, text=True, timeout=60
+        )
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return json.loads(process.stdout.splitlines()[-1]), process.stderr
+
+    def test_serves_without_renewal_imports(self):
+        result, _ = self.cold_get()
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['cryptography'], [])
+        self.assertEqual(result['services'], ['secretsmanager'])
+
+    def test_import_time_budget(self):
+        _, stderr = self.cold_get('-X', 'importtime')
+        # "import time: self [us] | cumulative | package", one line per module
+        total_us = sum(
+            int(line.split(':', 1)[1].split('|')[0])
+            for line in stderr.splitlines()
+            if line.startswith('import time:') and line.split(':', 1)[1].split('|')[0].strip().isdigit()
+        )
+        self.assertLess(total_us / 1000, COLD_START_IMPORT_BUDGET_MS)
+
+
+class TokenTest(unittest.TestCase):
+
+    def environment(self, tokens):
+        env = Environment(['home.example.com'], ['example.com'], env={'CERT_TOKEN': tokens})
+        self.addCleanup(env.close)
+        return env
+
+    def test_accepts_plain_and_hashed_tokens(self):
+        digest = hashlib.sha256(b'second').hexdigest().upper()
+        env = self.environment(f' first , sha256:{digest},,')
+        self.assertEqual(env.invoke(api_event(token='first'))[0]['statusCode'], 200)
+        self.assertEqual(env.invoke(api_event(token='second'))[0]['statusCode'], 200)
+        self.assertEqual(env.invoke(api_event(token=f'sha256:{digest}'))[0]['statusCode'], 403)
+
+    def test_skips_malformed_hashed_tokens(self):
+        # Loading the function must not fail, so renewals keep running
+        env = self.environment(f'good, sha256:{"ab" * 31}, sha256:{"zz" * 32}')
+        response, lines = env.invoke(api_event(token='good'))
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(len(env.module._token_digests), 1)
+        self.assertEqual([line['message'] for line in lines if line['level'] == 'WARNING'],
+                         ['Ignoring malformed sha256 token entry'] * 2)
+
+    def test_hashes_only_the_presented_token_per_request(self):
+        # The configured tokens are hashed once; each request costs one digest
+        env = self.environment(f'first, second, sha256:{"ab" * 32}')
+        env.invoke(api_event(token='first'))
+        with mock.patch.object(env.module.hashlib, 'sha256', wraps=hashlib.sha256) as sha256:
+            for token in ['first', 'second', 'wrong']:
+                env.module.authorized(f'Bearer {token}')
+        self.assertEqual(sha256.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
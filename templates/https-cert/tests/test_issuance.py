@@ -0,0 +1,168 @@
+"""End-to-end issuance against the fake CA, DNS stub and AWS clients."""
+
+import json
+import socket
+import unittest
+
+from fakes import Context, Environment, metrics_line
+
+DOMAINS = ['home.example.com', '*.example.com', 'example.com', 'www.example.org', 'api.example.net']
+ZONES = ['example.com', 'example.org', 'example.net']
+
+
+class IssuanceTest(unittest.TestCase):
+
+    def environment(self, domains=DOMAINS, zones=ZONES, **options):
+        env = Environment(domains, zones, **options)
+        self.addCleanup(env.close)
+        return env
+
+    def test_issues_one_certificate_across_zones(self):
+        env = self.environment(pending_polls=2, dns_lag=1, processing_polls=1)
+        result, lines = env.invoke({})
+
+        self.assertEqual(result['statusCode'], 200)
+        cert = env.secrets.current('cert')
+        self.assertEqual(cert['domains'], DOMAINS)
+        self.assertIn('BEGIN CERTIFICATE', cert['certificate'])
+        self.assertIn('pkcs12', cert)
+        self.assertNotIn('account_key', cert)
+        self.assertIn('account_key', env.secrets.current('account'))
+        self.assertEqual(env.secrets.current('state'), {})
+
+        # One ChangeBatch per zone to publish and one to clean up
+        self.assertEqual(env.route53.calls.count('change_resource_record_sets'), 2 * len(ZONES))
+        self.assertEqual(env.route53.records, {})
+
+        # Keep-alive: every ACME request shares a connection or two
+        self.assertLessEqual(env.acme.connections, 4)
+        self.assertEqual(env.acme.requests['order'], 4)      # new, ready check, two polls while processing
+        self.assertEqual(env.acme.requests['challenge'], 5)  # one per name, answered in parallel
+
+        metrics = metrics_line(lines)
+        self.assertEqual(metrics['Outcome'], 'issued')
+        self.assertEqual(metrics['HttpRequests'], env.acme.total_requests())
+        self.assertGreater(metrics['PropagationTime'], 0)
+
+        message = json.loads(env.sns.messages[0]['Message'])
+        self.assertEqual(message['fingerprint'], cert['fingerprint'])
+
+    def test_skips_renewal_while_certificate_is_valid(self):
+        env = self.environment()
+        env.invoke({})
+        requests = env.acme.total_requests()
+
+        result, lines = env.invoke({})
+        self.assertEqual(json.loads(result['body'])['message'], 'Certificate still valid')
+        self.assertEqual(env.acme.total_requests(), requests)
+        # A run with nothing to do publishes a single custom metric
+        metrics = metrics_line(lines)
+        self.assertEqual(metrics['Outcome'], 'skipped')
+        self.assertEqual([metric['Name'] for metric in metrics['_aws']['CloudWatchMetrics'][0]['Metrics']],
+                         ['TotalTime'])
+        self.assertNotIn('PropagationTime', metrics)
+
+    def test_suspends_and_resumes_from_checkpoint(self):
+        # Route 53 stays PENDING longer than the first invocation can wait
+        env = self.environment(pending_polls=10**6)
+        result, lines = env.invoke({}, Context(seconds=1.5))
+
+        self.assertEqual(result['statusCode'], 202)
+        self.assertEqual(metrics_line(lines)['Outcome'], 'suspended')
+        self.assertEqual(env.secrets.current('state')['step'], 'published')
+        self.assertEqual(len(env.lambda_client.invocations), 1)
+        self.assertEqual(json.loads(env.lambda_client.invocations[0]['Payload']), {'resume': True})
+        orders = env.acme.requests['order']
+
+        env.route53.changes = dict.fromkeys(env.route53.changes, 0)
+        result, lines = env.invoke({'resume': True})
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(metrics_line(lines)['Outcome'], 'issued')
+        # The resumed run carries on with the same order rather than starting again
+        self.assertEqual(len(env.acme.orders), 1)
+        self.assertGreater(env.acme.requests['order'], orders)
+        self.assertEqual(env.secrets.current('state'), {})
+        self.assertEqual(env.secrets.current('cert')['domains'], DOMAINS)
+
+    def test_gives_up_after_too_many_resumes(self):
+        env = self.environment(pending_polls=10**6)
+        env.module.MAX_RESUMES = 1
+        env.invoke({}, Context(seconds=1.5))
+
+        with self.assertRaisesRegex(Exception, 'did not complete after 1 resumes'):
+            env.invoke({'resume': True}, Context(seconds=1.5))
+        self.assertEqual(env.secrets.current('state'), {})
+
+    def test_pre_authorized_names_skip_dns(self):
+        env = self.environment(authz_valid=True)
+        result, _ = env.invoke({})
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertNotIn('change_resource_record_sets', env.route53.calls)
+        self.assertNotIn('challenge', env.acme.requests)
+
+    def test_unreachable_nameservers_fall_back_to_insync(self):
+        env = self.environment(pending_polls=1)
+        # A nameserver that never answers
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(silent.close)
+        silent.bind(('127.0.0.1', 0))
+        env.module.DNS_PORT = silent.getsockname()[1]
+        env.module.DNS_TIMEOUT = 0.05
+        result, lines = env.invoke({}, Context(seconds=20))
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertIn('Nameservers could not be queried, continuing as Route 53 reports the records in sync',
+                      [line.get('message') for line in lines])
+        # Gave up after a few rounds rather than waiting out PROPAGATION_TIMEOUT
+        self.assertLess(metrics_line(lines)['PropagationTime'], 5000)
+
+    def test_rejects_more_names_than_a_certificate_allows(self):
+        names = [f'host{i}.example.com' for i in range(101)]
+        env = self.environment(domains=names)
+
+        with self.assertRaisesRegex(Exception, 'at most 100'):
+            env.invoke({})
+        self.assertEqual(env.acme.total_requests(), 0)
+
+    def test_retries_bad_nonce(self):
+        env = self.environment(bad_nonces=2)
+        result, lines = env.invoke({})
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(metrics_line(lines)['AcmeRetries'], 2)
+
+    def test_retried_store_keeps_one_version(self):
+        env = self.environment()
+        env.invoke({})
+        stored = env.secrets.current('cert')
+
+        # Replay the last step, as a retried invocation would after a crash
+        # between storing the certificate and clearing the checkpoint
+        checkpoint = next(
+            version['SecretString'] for version in env.secrets.versions['state']
+            if json.loads(version['SecretString']).get('step') == 'issued'
+        )
+        env.secrets.put_secret_value(SecretId='state', SecretString=checkpoint)
+        result, lines = env.invoke({'resume': True})
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertIn('Certificate already stored', [line.get('message') for line in lines])
+        self.assertEqual(len(env.secrets.versions['cert']), 2)  # the initial '{}' and one certificate
+        self.assertEqual(env.secrets.current('cert')['fingerprint'], stored['fingerprint'])
+        self.assertEqual(json.loads(env.sns.messages[1]['Message'])['version'], stored['fingerprint'])
+
+    def test_failed_account_setup_keeps_checkpoint(self):
+        env = self.environment(pending_polls=10**6)
+        env.invoke({}, Context(seconds=1.5))
+        env.module.ACME_DIRECTORY = env.acme.base + '/missing'
+
+        with self.assertRaisesRegex(Exception, 'HTTP 404'):
+            env.invoke({'resume': True})
+        self.assertEqual(metrics_line(env.lines)['Outcome'], 'failed')
+        self.assertEqual(env.secrets.current('state')['step'], 'published')
+
+
+if __name__ == '__main__':
+    unittest.main()